@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import sys
+
+import coloredlogs
+
+import conversion_db
+import convergence
+from generate_tests import ENCODINGS, test_encoding
+from find_identical_intrinsics import find_common_outputs, refine_equivalences, report_equivalences
+
+
+def run_seed(seed, tests_folder, llc, log_folder, corner_cases=False, corpus=None, screen=False, failures=None,
+             encoding=None):
+    """Generate, build and run the testbeds for one seed. Returns the path of the test log
+
+    With screen, lowered testbeds are compared by static_screen.py before they are
+    assembled, and configurations that can never be equivalent are not built.
+    With failures, configurations that failed for earlier seeds are skipped, and
+    new failures are recorded in that file.
+    """
+    generate_command = ["python3", "generate_tests.py", "--seed", str(seed), "--output-folder", tests_folder]
+    if encoding is not None:
+        generate_command.extend(["--encoding", str(encoding)])
+    if corner_cases:
+        generate_command.append("--corner-cases")
+    if corpus:
+        generate_command.extend(["--corpus", corpus])
+    if failures:
+        generate_command.extend(["--failures", failures, "--llc", llc])
+
+    subprocess.run(["rm", "-rf", tests_folder], check=True)
+    subprocess.run(generate_command, check=True)
+    make_variables = ["LLC=" + llc, "TESTS=" + tests_folder]
+    if failures:
+        make_variables.append("FAILURES=" + failures)
+    make_command = ["make", "testbeds"] + make_variables
+    if screen:
+        make_command.append("SCREEN=" + log_folder)
+    subprocess.run(make_command, check=True)
+
+    log_path = os.path.join(log_folder, "testbeds_{}{}.log".format("corner" if corner_cases else "seed", seed))
+    with open(log_path, "w") as log_file:
+        subprocess.run(["make", "run-testbeds"] + make_variables, stdout=log_file, check=True)
+
+    return log_path
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Test seeds one at a time until equivalences stop changing")
+    parser.add_argument("first_seed", type=int)
+    parser.add_argument("last_seed", type=int)
+    parser.add_argument("--corner-cases", action="store_true",
+                        help="Use type-aware corner case inputs instead of uniformly random bytes")
+    parser.add_argument("--encoding", type=int, choices=ENCODINGS, default=None,
+                        help="Version of the encoding of input bits as constants, as for generate_tests.py "
+                             "(default: 2 with --corner-cases, 1 otherwise)")
+    parser.add_argument("--corpus", type=str, default=None,
+                        help="Read inputs from a corpus built by input_corpus.py")
+    parser.add_argument("--tests", type=str, default="tests",
+                        help="Folder in which to generate testbeds, e.g. a folder on a tmpfs")
+    parser.add_argument("--llc", type=str, default="llc",
+                        help="Path to llc")
+    parser.add_argument("--failures", type=str, default=None,
+                        help="Record configurations that fail to build or run in this file, and skip them for later seeds")
+    parser.add_argument("--screen", action="store_true",
+                        help="Compare lowered testbeds before building them, and skip those that can never be equivalent")
+    parser.add_argument("--output-folder", type=str, default="logs",
+                        help="Folder in which to store test logs and equivalences")
+    convergence.add_arguments(parser)
+    conversion_db.add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        encoding = test_encoding("corner" if args.corner_cases else "seed", args.encoding)
+    except ValueError as e:
+        parser.error(str(e))
+
+    coloredlogs.install()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    equivalences = {}
+    monitor = convergence.from_arguments(args)
+    for seed in range(args.first_seed, args.last_seed + 1):
+        log_path = run_seed(seed, args.tests, args.llc, args.output_folder, corner_cases=args.corner_cases,
+                            corpus=args.corpus, screen=args.screen, failures=args.failures,
+                            encoding=encoding)
+        refine_equivalences(equivalences, find_common_outputs(log_path))
+
+        monitor.update(equivalences, 1)
+        print("seed {:6} | {}".format(seed, monitor.summary()), file=sys.stderr)
+        if monitor.converged():
+            print("Converged after seed {}".format(seed), file=sys.stderr)
+            break
+
+    results = report_equivalences(equivalences, monitor.num_tests, args.output_folder)
+    conversion_db.record_from_arguments(args, results, monitor.num_tests, llc=args.llc,
+                                        provenance={"seeds": [args.first_seed, args.first_seed + monitor.num_tests - 1],
+                                                    "corner_cases": args.corner_cases,
+                                                    "encoding": encoding,
+                                                    "corpus": args.corpus})
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+
+class ConvergenceMonitor(object):
+    """Track equivalence classes as tests are refined in, and decide when to stop testing.
+
+    A campaign is considered converged after `patience` consecutive batches that
+    split no equivalence class, or once the upper confidence bound on the chance
+    that a further test splits a class drops below `max_split_probability`.
+    Treating tests as independent trials, after n consecutive tests without a
+    split that bound is 1 - (1 - confidence)^(1/n), roughly 3/n at 95% confidence.
+    """
+
+    def __init__(self, patience=None, max_split_probability=None, confidence=0.95):
+        self.patience = patience
+        self.max_split_probability = max_split_probability
+        self.confidence = confidence
+
+        self.num_batches = 0
+        self.num_tests = 0
+        self.num_classes = 0
+        self.candidate_pairs = 0
+        self.splits = 0
+        self.stable_batches = 0
+        self.stable_tests = 0
+
+    def update(self, equivalences, num_tests):
+        """Record the state of equivalences after a batch of num_tests tests.
+
+        Args:
+            equivalences: dict (str -> dict). Output of refine_equivalences.
+            num_tests: (int) Number of tests refined into equivalences by this batch.
+        """
+        classes = set(frozenset(equivs["targets"]) for equivs in equivalences.values())
+        num_classes = len(classes)
+        candidate_pairs = sum(len(cls) * (len(cls) - 1) // 2 for cls in classes)
+
+        self.splits = num_classes - self.num_classes
+        if self.num_batches and num_classes == self.num_classes and candidate_pairs == self.candidate_pairs:
+            self.stable_batches += 1
+            self.stable_tests += num_tests
+        else:
+            self.stable_batches = 0
+            self.stable_tests = 0
+
+        self.num_batches += 1
+        self.num_tests += num_tests
+        self.num_classes = num_classes
+        self.candidate_pairs = candidate_pairs
+
+    def split_probability_bound(self):
+        """Upper confidence bound on the probability that the next test splits a class"""
+        if self.stable_tests == 0:
+            return 1.0
+        return 1 - (1 - self.confidence) ** (1 / self.stable_tests)
+
+    def converged(self):
+        if self.patience is not None and self.stable_batches >= self.patience:
+            return True
+        if self.max_split_probability is not None and self.split_probability_bound() < self.max_split_probability:
+            return True
+        return False
+
+    def summary(self):
+        return ("tests {:6} | classes {:5} ({:+} this batch) | candidate pairs {:7} | "
+                "unchanged for {} batches, split probability < {:.3%} ({:.0%} confidence)").format(
+                    self.num_tests, self.num_classes, self.splits, self.candidate_pairs,
+                    self.stable_batches, self.split_probability_bound(), self.confidence)
+
+
+def add_arguments(parser):
+    """Add convergence options to an argparse parser"""
+    parser.add_argument("--patience", type=int, default=None,
+                        help="Stop after this many consecutive batches that split no equivalence class")
+    parser.add_argument("--max-split-probability", type=float, default=None,
+                        help="Stop once the chance that another test splits a class is bounded below this")
+    parser.add_argument("--confidence", type=float, default=0.95,
+                        help="Confidence level of the split probability bound")
+
+
+def from_arguments(args):
+    return ConvergenceMonitor(patience=args.patience,
+                              max_split_probability=args.max_split_probability,
+                              confidence=args.confidence)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import os
+import re
+import sqlite3
+import subprocess
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    created TEXT NOT NULL,
+    num_tests INTEGER NOT NULL,
+    llc_version TEXT,
+    mcpu TEXT,
+    provenance TEXT
+);
+CREATE TABLE IF NOT EXISTS configurations (
+    id INTEGER PRIMARY KEY,
+    intrinsic TEXT NOT NULL,
+    combination TEXT NOT NULL,
+    repeat INTEGER NOT NULL,
+    UNIQUE (intrinsic, combination, repeat)
+);
+CREATE INDEX IF NOT EXISTS configurations_intrinsic ON configurations (intrinsic);
+CREATE TABLE IF NOT EXISTS class_members (
+    campaign_id INTEGER NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+    class_id INTEGER NOT NULL,
+    configuration_id INTEGER NOT NULL REFERENCES configurations (id),
+    PRIMARY KEY (campaign_id, class_id, configuration_id)
+);
+CREATE INDEX IF NOT EXISTS class_members_configuration ON class_members (campaign_id, configuration_id);
+CREATE TABLE IF NOT EXISTS conversions (
+    campaign_id INTEGER NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+    base_id INTEGER NOT NULL REFERENCES configurations (id),
+    target_id INTEGER NOT NULL REFERENCES configurations (id),
+    vf INTEGER NOT NULL,
+    PRIMARY KEY (campaign_id, base_id, target_id)
+);
+CREATE INDEX IF NOT EXISTS conversions_base ON conversions (base_id);
+CREATE INDEX IF NOT EXISTS conversions_vf ON conversions (campaign_id, vf);
+"""
+
+CONVERSION_QUERY = """
+SELECT base.intrinsic, base.combination, base.repeat,
+       target.intrinsic, target.combination, target.repeat
+FROM conversions
+JOIN configurations AS base ON base.id = conversions.base_id
+JOIN configurations AS target ON target.id = conversions.target_id
+"""
+
+
+def parse_testbed_name(name):
+    """Return (intrinsic, combination, repeat) of a tests/<intrinsic>/combo_<C>/repeat_<N>/testbed name"""
+    _, intrinsic, combination, repeat, __ = name.split("/")
+    return intrinsic, combination.partition("_")[2], int(repeat.partition("_")[2])
+
+
+def llc_version(llc):
+    """Return the LLVM version reported by llc, or None if it cannot be run"""
+    try:
+        output = subprocess.run([llc, "--version"], stdout=subprocess.PIPE, universal_newlines=True).stdout
+    except OSError:
+        return None
+
+    m = re.search(r"LLVM version (\S+)", output)
+    return m.group(1) if m else None
+
+
+class ConversionDatabase(object):
+    """Indexed store of equivalence classes and conversions found by each campaign"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _configuration_id(self, intrinsic, combination, repeat):
+        self.connection.execute(
+                "INSERT OR IGNORE INTO configurations (intrinsic, combination, repeat) VALUES (?, ?, ?)",
+                (intrinsic, combination, repeat))
+        return self.connection.execute(
+                "SELECT id FROM configurations WHERE intrinsic = ? AND combination = ? AND repeat = ?",
+                (intrinsic, combination, repeat)).fetchone()[0]
+
+    def _campaign_id(self, campaign=None):
+        """ID of a campaign by name, or of the latest campaign"""
+        if campaign is None:
+            row = self.connection.execute("SELECT id FROM campaigns ORDER BY id DESC LIMIT 1").fetchone()
+        else:
+            row = self.connection.execute("SELECT id FROM campaigns WHERE name = ?", (campaign,)).fetchone()
+
+        if row is None:
+            raise KeyError("No campaign {} in database".format(campaign if campaign else ""))
+        return row[0]
+
+    def add_campaign(self, name, equivalence_lists, missed_list, conversions, num_tests,
+                     llc_version=None, mcpu=None, provenance=None):
+        """Record the results of a campaign, replacing any campaign with the same name.
+
+        Args:
+            equivalence_lists: lists of equivalent testbed names, as in test_equivalences.json.
+            missed_list: testbed names without equivalents, as in test_missed.json.
+            conversions: (base, target) dict pairs, as in test_conversions.json.
+            provenance: JSON-serializable description of inputs, e.g. seed ranges.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM campaigns WHERE name = ?", (name,))
+            cursor = self.connection.execute(
+                    "INSERT INTO campaigns (name, created, num_tests, llc_version, mcpu, provenance) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (name, datetime.datetime.now().isoformat(), num_tests, llc_version, mcpu,
+                     json.dumps(provenance)))
+            campaign_id = cursor.lastrowid
+
+            # Refined equivalence classes need not partition configurations, so a
+            # configuration is recorded in every class it belongs to
+            classes = list(equivalence_lists) + [[testbed_name] for testbed_name in missed_list]
+            for class_id, equivalence_list in enumerate(classes):
+                for testbed_name in set(equivalence_list):
+                    configuration_id = self._configuration_id(*parse_testbed_name(testbed_name))
+                    self.connection.execute(
+                            "INSERT INTO class_members (campaign_id, class_id, configuration_id) VALUES (?, ?, ?)",
+                            (campaign_id, class_id, configuration_id))
+
+            for base, target in conversions:
+                self.connection.execute(
+                        "INSERT OR IGNORE INTO conversions (campaign_id, base_id, target_id, vf) VALUES (?, ?, ?, ?)",
+                        (campaign_id,
+                         self._configuration_id(base["id"], base["combination"], base["repeat"]),
+                         self._configuration_id(target["id"], target["combination"], target["repeat"]),
+                         base["repeat"] // target["repeat"]))
+
+        return campaign_id
+
+    def campaigns(self):
+        """List of campaign dicts, oldest first"""
+        rows = self.connection.execute(
+                "SELECT name, created, num_tests, llc_version, mcpu, provenance FROM campaigns ORDER BY id")
+        return [{"name": name, "created": created, "num_tests": num_tests, "llc_version": llc,
+                 "mcpu": mcpu, "provenance": json.loads(provenance)}
+                for name, created, num_tests, llc, mcpu, provenance in rows]
+
+    def _conversions(self, where, parameters):
+        rows = self.connection.execute(CONVERSION_QUERY + where + " ORDER BY base.intrinsic, conversions.vf", parameters)
+        return [({"id": base_id, "combination": base_combination, "repeat": base_repeat},
+                 {"id": target_id, "combination": target_combination, "repeat": target_repeat})
+                for base_id, base_combination, base_repeat, target_id, target_combination, target_repeat in rows]
+
+    def conversions(self, campaign=None):
+        """(base, target) dict pairs of a campaign, in the format of test_conversions.json"""
+        return self._conversions("WHERE conversions.campaign_id = ?", (self._campaign_id(campaign),))
+
+    def targets_for(self, intrinsic, campaign=None):
+        """Conversions of a campaign whose base is the given intrinsic"""
+        return self._conversions("WHERE conversions.campaign_id = ? AND base.intrinsic = ?",
+                                 (self._campaign_id(campaign), intrinsic))
+
+    def conversions_by_vf(self, vf, campaign=None):
+        """Conversions of a campaign that replace vf base calls by one target call"""
+        return self._conversions("WHERE conversions.campaign_id = ? AND conversions.vf = ?",
+                                 (self._campaign_id(campaign), vf))
+
+    def equivalent_to(self, intrinsic, campaign=None):
+        """Testbed names in the same equivalence classes as any configuration of intrinsic"""
+        rows = self.connection.execute("""
+            SELECT DISTINCT other.intrinsic, other.combination, other.repeat
+            FROM configurations AS config
+            JOIN class_members AS member ON member.configuration_id = config.id
+            JOIN class_members AS peer ON peer.campaign_id = member.campaign_id AND peer.class_id = member.class_id
+            JOIN configurations AS other ON other.id = peer.configuration_id
+            WHERE config.intrinsic = ? AND member.campaign_id = ? AND other.id != config.id
+            ORDER BY other.intrinsic, other.combination, other.repeat
+            """, (intrinsic, self._campaign_id(campaign)))
+        return ["tests/{}/combo_{}/repeat_{}/testbed".format(*row) for row in rows]
+
+    def diff(self, campaign_a, campaign_b):
+        """Return (conversions only in campaign_a, conversions only in campaign_b)"""
+        def key(conversion):
+            return tuple(json.dumps(config, sort_keys=True) for config in conversion)
+
+        conversions_a = {key(conversion): conversion for conversion in self.conversions(campaign_a)}
+        conversions_b = {key(conversion): conversion for conversion in self.conversions(campaign_b)}
+        return ([conversions_a[k] for k in sorted(conversions_a.keys() - conversions_b.keys())],
+                [conversions_b[k] for k in sorted(conversions_b.keys() - conversions_a.keys())])
+
+
+def add_arguments(parser):
+    """Add options to record a campaign to an argparse parser"""
+    parser.add_argument("--database", type=str, default=None,
+                        help="SQLite conversion database in which to record this campaign")
+    parser.add_argument("--campaign", type=str, default=None,
+                        help="Name of the campaign in the database (default: current date and time)")
+    parser.add_argument("--mcpu", type=str, default="skylake-avx512",
+                        help="CPU testbeds were compiled for, recorded as provenance")
+
+
+def record_from_arguments(args, results, num_tests, llc=None, provenance=None):
+    """Record the (equivalence_lists, missed_list, conversions) returned by report_equivalences"""
+    if not args.database:
+        return
+
+    equivalence_lists, missed_list, conversions = results
+    database = ConversionDatabase(args.database)
+    database.add_campaign(args.campaign or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                          equivalence_lists, missed_list,
+                          [[config.to_dict() for config in conversion] for conversion in conversions],
+                          num_tests,
+                          llc_version=llc_version(llc) if llc else None,
+                          mcpu=args.mcpu,
+                          provenance=provenance)
+    database.close()
+
+
+def print_conversions(conversions):
+    for base, target in conversions:
+        print("{:3}x {:45} {:10} => {} {}".format(
+                base["repeat"] // target["repeat"], base["id"], base["combination"],
+                target["id"], target["combination"]))
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Query or import into the conversion database")
+    parser.add_argument("database", type=str,
+                        help="Path to the SQLite conversion database")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    import_parser = subparsers.add_parser("import", help="Record results written by find_identical_intrinsics.py")
+    import_parser.add_argument("name", type=str, help="Name of the campaign")
+    import_parser.add_argument("--folder", type=str, default="logs",
+                               help="Folder containing test_{equivalences,missed,conversions}.json")
+    import_parser.add_argument("--num-tests", type=int, required=True,
+                               help="Number of tests in the campaign")
+    import_parser.add_argument("--llc", type=str, default=None,
+                               help="llc used by the campaign, to record its version")
+    import_parser.add_argument("--mcpu", type=str, default="skylake-avx512",
+                               help="CPU testbeds were compiled for")
+    import_parser.add_argument("--provenance", type=str, default=None,
+                               help="Description of the campaign inputs, e.g. \"seeds 1-6500\"")
+
+    subparsers.add_parser("campaigns", help="List campaigns")
+
+    targets_parser = subparsers.add_parser("targets", help="Conversions of an intrinsic")
+    targets_parser.add_argument("intrinsic", type=str, help="Intrinsic ID, e.g. int_x86_sse2_packssdw_128")
+
+    equivalent_parser = subparsers.add_parser("equivalent", help="Configurations equivalent to an intrinsic")
+    equivalent_parser.add_argument("intrinsic", type=str, help="Intrinsic ID, e.g. int_x86_sse2_packssdw_128")
+
+    vf_parser = subparsers.add_parser("vf", help="Conversions with a vectorization factor")
+    vf_parser.add_argument("vf", type=int)
+
+    diff_parser = subparsers.add_parser("diff", help="Conversions that differ between two campaigns")
+    diff_parser.add_argument("campaign_a", type=str)
+    diff_parser.add_argument("campaign_b", type=str)
+
+    for subparser in (targets_parser, equivalent_parser, vf_parser):
+        subparser.add_argument("--campaign", type=str, default=None,
+                               help="Campaign to query (default: latest)")
+    args = parser.parse_args()
+
+    database = ConversionDatabase(args.database)
+
+    if args.command == "import":
+        results = []
+        for filename in ("test_equivalences.json", "test_missed.json", "test_conversions.json"):
+            with open(os.path.join(args.folder, filename), "r") as results_f:
+                results.append(json.load(results_f))
+
+        database.add_campaign(args.name, *results, num_tests=args.num_tests,
+                              llc_version=llc_version(args.llc) if args.llc else None,
+                              mcpu=args.mcpu,
+                              provenance=args.provenance)
+    elif args.command == "campaigns":
+        for campaign in database.campaigns():
+            print("{name}: {num_tests} tests, created {created}, llc {llc_version}, -mcpu={mcpu}, {provenance}".format(
+                    **campaign))
+    elif args.command == "targets":
+        print_conversions(database.targets_for(args.intrinsic, args.campaign))
+    elif args.command == "equivalent":
+        for name in database.equivalent_to(args.intrinsic, args.campaign):
+            print(name)
+    elif args.command == "vf":
+        print_conversions(database.conversions_by_vf(args.vf, args.campaign))
+    elif args.command == "diff":
+        only_a, only_b = database.diff(args.campaign_a, args.campaign_b)
+        print("Only in {}:".format(args.campaign_a))
+        print_conversions(only_a)
+        print("Only in {}:".format(args.campaign_b))
+        print_conversions(only_b)
+
+    database.close()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+
+from colorama import Fore, Style
+
+from testbed_manifest import BUILD_STAGES, Manifest
+
+
+@functools.lru_cache(maxsize=None)
+def toolchain_fingerprint(llc="llc", assembler="as", cc="gcc"):
+    """Hash of the versions of the tools that lower, assemble and link testbeds"""
+    digest = hashlib.blake2b(digest_size=16)
+    for tool in (llc, assembler, cc):
+        try:
+            version = subprocess.run([tool, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+        except OSError:
+            version = b"missing"
+        digest.update(tool.encode() + b"\0" + version + b"\0")
+    return digest.hexdigest()
+
+
+def properties_fingerprint(properties):
+    return hashlib.blake2b(json.dumps(properties, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+class FailureCache(object):
+    """Persistent record of configurations that failed to generate, build or run.
+
+    Failures are keyed by configuration ID, or by intrinsic for intrinsics that
+    cannot be tested at all, and stored per toolchain fingerprint. A failure only
+    applies while the toolchain and the intrinsic's record are unchanged, so
+    configurations are retried after upgrading llc or regenerating
+    intrinsics_all.json.
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.toolchains = {}
+        if os.path.exists(path):
+            with open(path, "r") as failures_f:
+                self.toolchains = json.load(failures_f)
+        self.failures = self.toolchains.setdefault(fingerprint, {})
+
+    def failure(self, key, properties):
+        """Return the recorded failure of a configuration or intrinsic, or None if it should be tried"""
+        entry = self.failures.get(key)
+        if entry is not None and entry["properties"] == properties_fingerprint(properties):
+            return entry
+        return None
+
+    def record(self, key, properties, stage, reason):
+        self.failures[key] = {
+            "stage": stage,
+            "reason": re.sub(r"\x1b\[[0-9;]*m", "", reason).strip(),
+            "properties": properties_fingerprint(properties),
+        }
+
+    def save(self):
+        with open(self.path, "w") as failures_f:
+            json.dump(self.toolchains, failures_f, indent=1, sort_keys=True)
+
+    def __len__(self):
+        return len(self.failures)
+
+
+def error_summary(errors, default):
+    """First error line in the error output of a failed tool, or its last line, or default"""
+    lines = [line.strip() for line in errors.splitlines() if line.strip()]
+    for line in lines:
+        if "error" in line.lower():
+            return line
+    return lines[-1] if lines else default
+
+
+def error_reason(error_path, default):
+    """Summary of an error log written by a failed tool, or default"""
+    if not os.path.exists(error_path):
+        return default
+    with open(error_path, "r", errors="replace") as error_f:
+        return error_summary(error_f.read(), default)
+
+
+def record_build_failures(manifest, failures, stages=None):
+    """Record configurations of a manifest whose testbed did not lower, assemble or link.
+
+    `make testbeds` writes the error output of llc and gcc to <artifact>.err.
+    Only the given stages, which must have run already, are checked.
+    Returns the number of failures recorded.
+    """
+    num_failures = 0
+    for identifier in manifest:
+        _, properties, __, ___ = manifest.configuration(identifier)
+        path = manifest.artifact_path(identifier)
+        for stage, source, product in BUILD_STAGES:
+            if stages is not None and stage not in stages:
+                continue
+            if os.path.exists(path + source) and not os.path.exists(path + product):
+                failures.record(identifier, properties, stage,
+                                error_reason(path + source + ".err", "{} produced no output".format(stage)))
+                num_failures += 1
+                break
+    return num_failures
+
+
+def exit_reason(returncode):
+    if returncode < 0:
+        return "killed by signal {}".format(-returncode)
+    return "exit status {}".format(returncode)
+
+
+def add_arguments(parser):
+    """Add failure cache options to an argparse parser"""
+    parser.add_argument("--failures", type=str, default=None,
+                        help="Skip configurations recorded as failing in this file, and record new failures")
+    parser.add_argument("--llc", type=str, default="llc",
+                        help="Path to llc. Recorded failures only apply to the llc version they were recorded with")
+
+
+def from_arguments(args):
+    if not args.failures:
+        return None
+    return FailureCache(args.failures, toolchain_fingerprint(args.llc))
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Record and list configurations that fail to build or run")
+    parser.add_argument("command", choices=["record", "list"],
+                        help="record: record build failures of the testbeds in a folder; list: print recorded failures")
+    parser.add_argument("folder", type=str, nargs="?", default="tests",
+                        help="Folder containing manifest.json, for the record command")
+    parser.add_argument("--stages", type=str, nargs="+", choices=[stage for stage, _, __ in BUILD_STAGES],
+                        default=None, help="Build stages that have run, for the record command (default: all)")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    failures = from_arguments(args)
+    if failures is None:
+        parser.error("--failures is required")
+
+    if args.command == "record":
+        num_failures = record_build_failures(Manifest.load(args.folder), failures, stages=args.stages)
+        failures.save()
+        print("{}Recorded {} build failures, {} failures in total{}".format(
+                  Fore.YELLOW, num_failures, len(failures), Style.RESET_ALL),
+              file=sys.stderr)
+    elif args.command == "list":
+        for key, entry in sorted(failures.failures.items()):
+            print("{:60} {:8} {}".format(key, entry["stage"], entry["reason"]))
@@ -4,6 +4,7 @@ import argparse
 from collections import defaultdict, namedtuple
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import difflib
+import functools
 import itertools
 import json
 import logging
@@ -12,26 +13,14 @@ import os
 from pprint import pprint
 import re
 
-import coloredlogs
 from colorama import Fore, Style
-import Levenshtein
-
-from IPython import embed
-import pdb
 
+import conversion_db
 from utilities import Combination, get_type, tqdm_parallel_map
 
-coloredlogs.install()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-parser = argparse.ArgumentParser(description="Find identical intrinsics")
-parser.add_argument("--log", type=str, nargs="+",
-                    help="Log from generate_tests.py to process to find candidates")
-parser.add_argument("--output-folder", type=str, required=True,
-                    help="Folder in which to log equivalences")
-args = parser.parse_args()
-
 
 class Configuration(object):
     def __init__(self, id, combination, repeat):
@@ -58,10 +47,12 @@ class Configuration(object):
                 repeat=self.repeat)
 
     def __hash__(self):
-        # This is a terrible hash, but solves a non-determinacy bug in which
-        # filter_high_repetitions produces variable length outputs
-        return 0
-        #return hash((self.id, self.combination.name, self.repeat))
+        return hash((self.id, self.combination.name, self.repeat))
+
+    def __lt__(self, other):
+        # Ordering makes conversion planning independent of set iteration order
+        return ((self.id, self.combination.name, self.repeat) <
+                (other.id, other.combination.name, other.repeat))
 
     def __eq__(self, other):
         return (self.id == other.id and
@@ -120,95 +111,55 @@ def refine_equivalences(equivalences, candidate_equivalences):
                 }
 
 
-def filter_ucomi(conversions):
-    """Filter out false equivalences between sse2.comi... and sse2.ucomi...
+# Instruction sets from oldest to newest. Conversions between configurations with the
+# same vectorization factor upgrade to a newer instruction set.
+ordered_instruction_sets = ["sse", "sse2", "sse3", "ssse3", "sse41", "sse42", "avx", "avx2", "fma", "avx512"]
 
-    The intrinsics sse2.comi<lt/le/gt/ge> and see2.ucomi<lt/le/gt/ge> have different exception handing behavior.
-    """
-    for pair in conversions:
-        m = re.match("int_x86_([a-z0-9]+)_(u?)comi", pair[0].id)
-        if m:
-            if m.group(2) == "u" and re.match("int_x86_([a-z0-9]+)_comi", pair[1].id):
-                continue
-            elif m.group(2) == "" and re.match("int_x86_([a-z0-9]+)_ucomi", pair[1].id):
-                continue
+# Rules that reject conversions between semantically different intrinsics, by name.
+# Each rule takes a (base, target) pair of configurations and returns True to keep it.
+conversion_filters = {}
 
-        yield pair
 
+def conversion_filter(filter_fn):
+    """Register a conversion rule used by recommend_conversions"""
+    conversion_filters[filter_fn.__name__] = filter_fn
+    return filter_fn
 
-def filter_high_repetitions(conversions):
-    """Simplify conversions
-
-    Example: don't convert 4x sse2 into 2x avx2, if a 2x sse2 to 1x avx2 conversion is available.
-    """
-    simple_conversions = set()
-    for conversion in conversions:
-        repeat_0 = conversion[0].repeat
-        repeat_1 = conversion[1].repeat
-        gcd = math.gcd(repeat_0, repeat_1)
-
-        if gcd > 1:
-            simple_conversion = (
-                Configuration(id=conversion[0].id,
-                              combination=conversion[0].combination,
-                              repeat=(repeat_0 // gcd)),
-                Configuration(id=conversion[1].id,
-                              combination=conversion[1].combination,
-                              repeat=(repeat_1 // gcd))
-            )
-
-            # Add the reduced conversion, if it doesn't exist
-            simple_conversions.add(simple_conversion)
-        else:
-            # Simplest conversion available
-            simple_conversions.add(conversion)
-
-    return list(simple_conversions)
 
+@conversion_filter
+def filter_ucomi(base, target):
+    """Filter out false equivalences between sse2.comi... and sse2.ucomi...
 
-def order_pairs(conversions):
-    """Order conversion tuples: (source_config, target_config)"""
-    ordered_instruction_sets = ["sse", "sse2", "sse3", "ssse3", "sse41", "avx", "avx2", "fma", "avx512"]
+    The intrinsics sse2.comi<lt/le/gt/ge> and see2.ucomi<lt/le/gt/ge> have different exception handing behavior.
+    """
+    for a, b in ((base, target), (target, base)):
+        m = re.match("int_x86_([a-z0-9]+)_(u?)comi", a.id)
+        if m:
+            if m.group(2) == "u" and re.match("int_x86_([a-z0-9]+)_comi", b.id):
+                return False
+            elif m.group(2) == "" and re.match("int_x86_([a-z0-9]+)_ucomi", b.id):
+                return False
 
-    for conversion in conversions:
-        a, b = conversion
-
-        VF = a.repeat / b.repeat
-        power = ordered_instruction_sets.index(b.instruction_set) - ordered_instruction_sets.index(a.instruction_set)
-
-        # Heuristic: Consolidate repeated intrinsics
-        if VF > 1:
-            yield conversion
-        elif VF < 1:
-            yield (b, a)
-        elif a.id != b.id:
-            if power > 0:
-                yield conversion
-            elif power < 0:
-                yield conversion
-            else:
-                logger.warn("Unclear conversion direction for intrinsics:\n  base:   {}\n  target: {}".format(a, b))
+    return True
 
 
-def filter_differing_arguments(conversions):
-    with open("intrinsics_all.json", "r") as intrinsics_f:
-        intrinsics = json.load(intrinsics_f)
+def argument_signature(configuration, intrinsics):
+    """Element types of an intrinsic's parameters. Only intrinsics with equal signatures are converted"""
+    if configuration.id not in intrinsics:
+        logger.warn("Equivalence found, but IID not present in intrinsics_all.json: %s", configuration)
+        return None
 
-    for conversion in conversions:
-        if conversion[0].id not in intrinsics or conversion[1].id not in intrinsics:
-            logger.warn("Conversion found, but IID not present in intrinsics_all.json:")
-            logger.warn("  %s => %s", conversion[0], conversion[1])
-            continue
+    try:
+        return tuple(get_type(ty)[2] for ty in intrinsics[configuration.id]["ParamTypes"])
+    except TypeError:
+        return None
 
-        params0 = intrinsics[conversion[0].id]["ParamTypes"]
-        params1 = intrinsics[conversion[1].id]["ParamTypes"]
 
-        if len(params0) == len(params1):
-            element_types0 = tuple(map(lambda ty: get_type(ty)[2], params0))
-            element_types1 = tuple(map(lambda ty: get_type(ty)[2], params1))
+@functools.lru_cache(maxsize=None)
+def operation_distance(operation_a, operation_b):
+    import Levenshtein
 
-            if element_types0 == element_types1:
-                yield conversion
+    return Levenshtein.distance(operation_a, operation_b)
 
 
 def pick_target(base_configuration, targets):
@@ -220,18 +171,18 @@ def pick_target(base_configuration, targets):
     targets = filter(lambda conf: conf.repeat == min_repeat, targets)
 
     # Select targets with the most similar operation names
-    distances = {conf: Levenshtein.distance(base_configuration.operation, conf.operation) for conf in targets}
+    distances = {conf: operation_distance(base_configuration.operation, conf.operation) for conf in targets}
     min_distance = min(distances.values())
     targets = [conf for conf, distance in distances.items() if distance == min_distance]
 
     # Remove an unnecessary VERTICAL configuration if the ANY configuration is present
-    # FIXME: recommend_conversions should make this unnecessary
+    # in another equivalence class
     filtered = []
     for target in targets:
         if (target.combination == Combination.ANY or
             Configuration(id=target.id, combination=Combination.ANY, repeat=target.repeat) not in targets):
             filtered.append(target)
-    targets = filtered
+    targets = sorted(filtered)
 
     if len(targets) > 1:
         logger.error("Even after filtering, multiple conversion candidates for {}. Picking first.".format(base_configuration))
@@ -242,74 +193,110 @@ def pick_target(base_configuration, targets):
     return targets[0]
 
 
-def remove_duplicate_targets(conversions):
-    """If multiple conversions are possible for an intrinsic configuration, choose one per target instruction set, or skip"""
-    # Build two level map: base configuration => target instruction_set => list of targets
-    conversion_map = defaultdict(lambda: defaultdict(list))
-    for conversion in conversions:
-        base, target = conversion
-        conversion_map[base][target.instruction_set].append(target)
+def parse_equivalence_list(equivalence_list):
+    """Parse testbed names into configurations, merging HORIZONTAL and VERTICAL configurations into ANY"""
+    equivalent_configurations = set()
 
-    for base, targets_by_instruction_set in conversion_map.items():
-        for targets in targets_by_instruction_set.values():
-            # Choose one target out of candidates in the same instruction set
-            target = pick_target(base, targets)
-            yield (base, target)
+    for config_str in equivalence_list:
+        # Parse intrinsic configuration name
+        _, intrin_id, combination, repeat, __ = config_str.split("/")
 
+        _, __, combination = combination.partition("_")
+        combination = Combination[combination]
 
-def recommend_conversions(equivalence_lists):
-    """Given lists of equivalent testbeds, generate conversion pairs."""
-    pairs = []
+        repeat = int(repeat.partition("_")[2])
 
-    for equivalence_list in equivalence_lists:
-        equivalent_configurations = set()
+        configuration = Configuration(id=intrin_id,
+                                      combination=combination,
+                                      repeat=repeat)
+        equivalent_configurations.add(configuration)
 
-        for config_str in equivalence_list:
-            # Parse intrinsic configuration name
-            _, intrin_id, combination, repeat, __ = config_str.split("/")
+    # If both vertical and horizontal combinations are possible, specify only an ANY combination
+    deduplicated = set()
+    for config in equivalent_configurations:
+        alt_config = Configuration(id=config.id,
+                                   combination=Combination.VERTICAL if config.combination == Combination.HORIZONTAL else Combination.HORIZONTAL,
+                                   repeat=config.repeat)
 
-            _, __, combination = combination.partition("_")
-            combination = Combination[combination]
+        if alt_config in equivalent_configurations:
+            deduplicated.add(Configuration(config.id, Combination.ANY, config.repeat))
+        else:
+            deduplicated.add(config)
 
-            repeat = int(repeat.partition("_")[2])
+    return sorted(deduplicated)
 
-            configuration = Configuration(id=intrin_id,
-                                          combination=combination,
-                                          repeat=repeat)
-            equivalent_configurations.add(configuration)
 
-        # If both vertical and horizontal combinations are possible, specify only an ANY combination
-        deduplicated = set()
-        for config in equivalent_configurations:
-            alt_config = Configuration(id=config.id,
-                                       combination=Combination.VERTICAL if config.combination == Combination.HORIZONTAL else Combination.HORIZONTAL,
-                                       repeat=config.repeat)
+def recommend_conversions(equivalence_lists, intrinsics=None, filters=None):
+    """Given lists of equivalent testbeds, generate minimal k-to-1 conversion pairs.
 
-            if alt_config in equivalent_configurations:
-                deduplicated.add(Configuration(config.id, Combination.ANY, config.repeat))
-            else:
-                deduplicated.add(config)
+    Each equivalence class is indexed by argument signature, instruction set and
+    repeat, so candidate targets for a configuration are looked up per bucket
+    rather than by enumerating every pair in the class. A base repeated k times
+    and a target repeated m <= k times reduce to a (k / m)-to-1 conversion.
+    Conversions with k == m only upgrade to a newer instruction set. For each
+    base and target instruction set, pick_target then chooses one target.
 
-        if len(deduplicated) > 1:
-            combinations = itertools.combinations(deduplicated, 2)
-            pairs.extend(combinations)
+    Args:
+        equivalence_lists: list of lists of equivalent testbed names.
+        intrinsics: dict of intrinsic records. Loaded from intrinsics_all.json by default.
+        filters: names of registered conversion_filters to apply. All of them by default.
+    """
+    if intrinsics is None:
+        with open("intrinsics_all.json", "r") as intrinsics_f:
+            intrinsics = json.load(intrinsics_f)
 
-    # Filter out semantically different instructions with rules
-    filter_steps = [
-        "filter_ucomi",
-        "filter_high_repetitions",
-        "filter_differing_arguments",
-        "order_pairs",
-        "remove_duplicate_targets",
-    ]
+    filter_fns = [conversion_filters[name] for name in (filters if filters is not None else sorted(conversion_filters))]
+    isa_rank = {instruction_set: rank for rank, instruction_set in enumerate(ordered_instruction_sets)}
 
-    for filter_fn_name in filter_steps:
-        num_pairs = len(pairs)
-        filter_fn = eval(filter_fn_name)
-        pairs = list(filter_fn(pairs))
-        logger.info("FILTER ({}): {} => {} conversion pairs".format(filter_fn_name, num_pairs, len(pairs)))
+    # (reduced base configuration, target instruction set) => candidate target configurations
+    candidates = defaultdict(set)
+    num_candidates = 0
+    num_filtered = 0
 
-    return pairs
+    for equivalence_list in equivalence_lists:
+        configurations = parse_equivalence_list(equivalence_list)
+        if len(configurations) < 2:
+            continue
+
+        # Index the class: argument signature => (instruction set, repeat) => configurations
+        index = defaultdict(lambda: defaultdict(list))
+        for config in configurations:
+            signature = argument_signature(config, intrinsics)
+            if signature is not None:
+                index[signature][(config.instruction_set, config.repeat)].append(config)
+
+        for buckets in index.values():
+            for (base_isa, base_repeat), bases in buckets.items():
+                for (target_isa, target_repeat), targets in buckets.items():
+                    # Consolidate repeated intrinsics, or upgrade the instruction set
+                    if base_repeat % target_repeat:
+                        continue
+                    if base_repeat == target_repeat and not (
+                            base_isa in isa_rank and target_isa in isa_rank and
+                            isa_rank[base_isa] < isa_rank[target_isa]):
+                        continue
+
+                    VF = base_repeat // target_repeat
+                    for base in bases:
+                        reduced_base = Configuration(base.id, base.combination, VF)
+                        for target in targets:
+                            if base.id == target.id:
+                                continue
+
+                            num_candidates += 1
+                            reduced_target = Configuration(target.id, target.combination, 1)
+                            if all(filter_fn(reduced_base, reduced_target) for filter_fn in filter_fns):
+                                candidates[(reduced_base, target_isa)].add(reduced_target)
+                            else:
+                                num_filtered += 1
+
+    conversions = []
+    for (base, _), targets in sorted(candidates.items()):
+        conversions.append((base, pick_target(base, list(targets))))
+
+    logger.info("PLAN: {} candidate conversions, {} filtered by rules, {} conversions picked".format(
+            num_candidates, num_filtered, len(conversions)))
+    return conversions
 
 
 def serialize_conversions(conversions, fp):
@@ -324,27 +311,25 @@ def serialize_conversions(conversions, fp):
 
     json.dump(conversions_serializable, fp)
 
-if __name__=="__main__":
-    # Build & refine equivalence set by candidates from test logs
-    logger.info("Parsing test log files to extract equivalence lists")
-    executor = ProcessPoolExecutor()
-    all_log_equivalences = tqdm_parallel_map(executor, find_common_outputs, args.log)
+def report_equivalences(equivalences, num_tests, output_folder, intrinsics=None):
+    """Write refined equivalences, missed configurations and recommended conversions to output_folder
 
-    # Given these equivalence lists, build and refine equivalence sets
-    equivalences = {}
-    for log_equivalences in all_log_equivalences:
-        refine_equivalences(equivalences, log_equivalences)
-        #count = sum(map(len, equivalences.values()))
-        #logger.info("REFINED equivalences {:6}".format(count))
+    Returns (equivalence_lists, missed_list, conversions).
 
+    Args:
+        equivalences: dict (str -> dict). Output of refine_equivalences.
+        num_tests: (int) Number of tests every configuration must have been refined by.
+        output_folder: (str) Folder in which to write test_{equivalences,missed,conversions}.json.
+        intrinsics: dict of intrinsic records, passed to recommend_conversions.
+    """
     final_count = sum(map(len, equivalences.values()))
     logger.info("REFINED equivalences {:6}".format(final_count))
 
     # Remove duplicate equivalence sets
     equivalences_dedup = set()
     for equivs in equivalences.values():
-        if equivs["num_tests"] < len(args.log):
-            logger.warn("Equivalences {} have not been tested {} times, skipping".format(equivs, len(args.log)))
+        if equivs["num_tests"] < num_tests:
+            logger.warn("Equivalences {} have not been tested {} times, skipping".format(equivs, num_tests))
             continue
 
         equiv_set = frozenset(equivs["targets"])
@@ -365,14 +350,14 @@ if __name__=="__main__":
     missed_list.sort()
 
     # Write equivalences to a JSON file
-    with open(os.path.join(args.output_folder, "test_equivalences.json"), "w") as equiv_f:
+    with open(os.path.join(output_folder, "test_equivalences.json"), "w") as equiv_f:
         json.dump(equivalence_lists, equiv_f)
 
-    with open(os.path.join(args.output_folder, "test_missed.json"), "w") as missed_f:
+    with open(os.path.join(output_folder, "test_missed.json"), "w") as missed_f:
         json.dump(missed_list, missed_f)
 
     # Find pairs of conversions from lists of equivalent intrinsics
-    conversions = recommend_conversions(equivalence_lists)
+    conversions = recommend_conversions(equivalence_lists, intrinsics=intrinsics)
 
     logger.info("Found {} conversions".format(len(conversions)))
     for conversion in conversions:
@@ -380,6 +365,35 @@ if __name__=="__main__":
         if "ssse3" in conversion[0].id or "ssse3" in conversion[1].id:
              logger.info("  VF: {}, {} => {}".format(VF, *conversion))
 
-    with open(os.path.join(args.output_folder, "test_conversions.json"), "w") as conversions_f:
+    with open(os.path.join(output_folder, "test_conversions.json"), "w") as conversions_f:
         serialize_conversions(conversions, conversions_f)
 
+    return equivalence_lists, missed_list, conversions
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Find identical intrinsics")
+    parser.add_argument("--log", type=str, nargs="+",
+                        help="Log from generate_tests.py to process to find candidates")
+    parser.add_argument("--output-folder", type=str, required=True,
+                        help="Folder in which to log equivalences")
+    conversion_db.add_arguments(parser)
+    args = parser.parse_args()
+
+    import coloredlogs
+
+    coloredlogs.install()
+
+    # Build & refine equivalence set by candidates from test logs
+    logger.info("Parsing test log files to extract equivalence lists")
+    executor = ProcessPoolExecutor()
+    all_log_equivalences = tqdm_parallel_map(executor, find_common_outputs, args.log)
+
+    # Given these equivalence lists, build and refine equivalence sets
+    equivalences = {}
+    for log_equivalences in all_log_equivalences:
+        refine_equivalences(equivalences, log_equivalences)
+        #count = sum(map(len, equivalences.values()))
+        #logger.info("REFINED equivalences {:6}".format(count))
+
+    results = report_equivalences(equivalences, len(args.log), args.output_folder)
+    conversion_db.record_from_arguments(args, results, len(args.log), provenance={"logs": args.log})
@@ -2,33 +2,77 @@
 
 import argparse
 from collections import defaultdict
-import coloredlogs
 import datetime
 import json
 import logging
+import os
+import sys
+
+from colorama import Fore, Style
 
 from jinja2 import Template
 
-coloredlogs.install()
+from conversion_db import ConversionDatabase
+import record_utils
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Templates and data are found relative to this file, so headers can be emitted from any directory
+TEMPLATE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
 
 def make_map_source(conversions):
     # date = datetime.date.today().strftime("%B %d, %Y")
-    with open("templates/IntrinsicConversion.h.tmpl", "r") as template_f:
+    with open(os.path.join(TEMPLATE_FOLDER, "IntrinsicConversion.h.tmpl"), "r") as template_f:
         template = Template(template_f.read())
 
     output_conversions = format_conversions_all(conversions)
     source = template.render(lane_widening_conversions=output_conversions)
     return source
 
+def make_table_source(conversions, intrinsics=None):
+    with open(os.path.join(TEMPLATE_FOLDER, "IntrinsicConversionTable.h.tmpl"), "r") as template_f:
+        template = Template(template_f.read())
+
+    entries = format_conversions_table(conversions, intrinsics=intrinsics)
+    source = template.render(lane_widening_entries=entries)
+    return source
+
+def format_conversions_table(conversions, intrinsics=None):
+    """Flatten conversions into (base_key, VF, target_key) entries, sorted by (Intrinsic::ID of base, VF)
+
+    This is the order of the C++ comparator of the table. A base intrinsic and
+    VF can have several targets, one per target ISA, which are kept next to each
+    other and ordered by Intrinsic::ID. Intrinsic IDs are ordered with the
+    records of intrinsics (default: intrinsics_all.json), as TableGen numbers them.
+    """
+    if intrinsics is None:
+        from intransitive import load_intrinsics
+
+        intrinsics = load_intrinsics()
+
+    entries = []
+    for base_key, targets in format_conversions_all(conversions):
+        for VF, target_key in targets:
+            entries.append((base_key, VF, target_key))
+
+    def id_key(key):
+        name = "int_" + key
+        if name not in intrinsics:
+            raise ValueError("No record of intrinsic {} to order it by Intrinsic::ID".format(name))
+        return record_utils.intrinsic_id_key(name, intrinsics[name])
+
+    entries.sort(key=lambda entry: (id_key(entry[0]), entry[1], id_key(entry[2])))
+    return entries
+
 def format_conversions_all(conversions):
     # Load a list of intrinsic IDs that appear to be removed
     # from the llvm::Intrinsic namespace
     # TODO: move this find_identical_intrinsics.py
     removed_intrinsics = set()
-    with open("data/removed_intrinsics.txt", "r") as id_f:
+    with open(os.path.join(DATA_FOLDER, "removed_intrinsics.txt"), "r") as id_f:
         for IID in id_f:
             removed_intrinsics.add(IID.strip())
 
@@ -83,16 +127,38 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser(description="Generate header file containing intrinsic conversions")
     parser.add_argument("--input", type=str, required=False, default="logs/test_conversions.json",
                         help="Path to conversions JSON file")
+    parser.add_argument("--database", type=str, default=None,
+                        help="Read conversions from a conversion database instead of --input")
+    parser.add_argument("--campaign", type=str, default=None,
+                        help="Campaign in the conversion database (default: latest)")
     parser.add_argument("--output", type=str, required=False, default="gen/IntrinsicConversion.h",
                         help="Path to which to output header file")
+    parser.add_argument("--format", choices=["map", "table"], default="map",
+                        help="Fill a SmallDenseMap at runtime, or emit a constant table sorted by intrinsic ID")
     args = parser.parse_args()
 
-    conversions = []
+    import coloredlogs
 
-    with open(args.input, "r") as input_f:
-        conversions = json.load(input_f)
+    coloredlogs.install()
+
+    conversions = []
 
-    header_source = make_map_source(conversions)
+    if args.database:
+        database = ConversionDatabase(args.database)
+        conversions = database.conversions(args.campaign)
+        database.close()
+    else:
+        with open(args.input, "r") as input_f:
+            conversions = json.load(input_f)
+
+    if args.format == "table":
+        try:
+            header_source = make_table_source(conversions)
+        except ValueError as e:
+            print("{}{}{}".format(Fore.RED, e, Style.RESET_ALL), file=sys.stderr)
+            sys.exit(1)
+    else:
+        header_source = make_map_source(conversions)
 
     with open(args.output, "w") as output_f:
         output_f.write(header_source)
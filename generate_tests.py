@@ -15,19 +15,11 @@ import traceback
 
 from colorama import Fore, Style
 
+import failure_cache
 import record_utils
+from testbed_manifest import Manifest, config_id
 from utilities import Combination, get_type, type_to_format
 
-parser = argparse.ArgumentParser(description="Generate testbeds for intrinsic equality testing")
-parser.add_argument("--seed", type=int, required=False, default=0,
-                    help="Seed for the input generator. The default of 0 indicates that edge cases should be generated.")
-parser.add_argument("--test-index", type=int, required=False, default=0,
-                    help="Index of generated test (made of specific byte chunks)")
-parser.add_argument("--max-bits", type=int, default=2048,
-                    help="Maximum number of bits to generate for inputs")
-#parser.add_argument("--shuffle-input", type=int, default=0x000102030405060708090A0B0C0D0E0F101112131415161718191A1B1C1D1E1F02122232425262728292A2B2C2D2E2F303132333435363738393A3B3C3D3E3F404142434445464748494A4B4C4D4E4F505152535455565758595A5B5C5D5E5F)
-args = parser.parse_args()
-
 test_byte_chunks = [
     "00" * 8,
     "10" * 8,
@@ -58,13 +50,179 @@ def random_bytes(num_bytes, seed):
 
     return value
 
+def element_corner_cases(element_type, element_bits):
+    """Return boundary bit patterns for a vector element type, as unsigned integers"""
+    mask = (1 << element_bits) - 1
+    sign = 1 << (element_bits - 1)
+
+    if element_type in ("float", "double"):
+        mantissa_bits = 23 if element_type == "float" else 52
+        exponent = mask ^ sign ^ ((1 << mantissa_bits) - 1)
+        quiet = 1 << (mantissa_bits - 1)
+        float_format, int_format = ("<f", "<I") if element_type == "float" else ("<d", "<Q")
+
+        values = {
+            0, sign,                                # +0, -0
+            exponent, sign | exponent,              # +inf, -inf
+            exponent | quiet, sign | exponent | quiet,  # quiet NaNs
+            exponent | 1, sign | exponent | 1,      # signaling NaNs
+            1, sign | 1,                            # smallest denormals
+            (1 << mantissa_bits) - 1,               # largest denormal
+            1 << mantissa_bits,                     # smallest normal
+            exponent - 1, sign | (exponent - 1),    # largest finite
+        }
+        # Rounding and float to integer conversion boundaries
+        for number in (1.0, -1.0, 0.5, -0.5, 1.5, 2.5, 2.0 ** 15, -2.0 ** 15 - 1,
+                       2.0 ** 31, -2.0 ** 31, 2.0 ** 32, 2.0 ** 63, -2.0 ** 63):
+            values.add(struct.unpack(int_format, struct.pack(float_format, number))[0])
+        return sorted(values)
+
+    if element_type[0] == "i":
+        values = {0, 1, mask, sign, sign - 1}
+        # Saturation boundaries when packing to narrower signed and unsigned types
+        narrow_bits = element_bits // 2
+        while narrow_bits >= 8:
+            for number in (2 ** (narrow_bits - 1) - 1, 2 ** (narrow_bits - 1),
+                           -2 ** (narrow_bits - 1), -2 ** (narrow_bits - 1) - 1,
+                           2 ** narrow_bits - 1, 2 ** narrow_bits):
+                values.add(number & mask)
+            narrow_bits //= 2
+        return sorted(values)
+
+    raise TypeError("Invalid element type {}".format(element_type))
+
+def input_element_types(intrinsics):
+    """Return sorted (element_type, element_bits) pairs of the vector parameters of intrinsics"""
+    element_types = set()
+    for properties in intrinsics.values():
+        for param_type in properties["ParamTypes"]:
+            if re.match("llvm_v[0-9]+", param_type):
+                _, __, element_type, element_bits = get_type(param_type)
+                element_types.add((element_type, element_bits))
+
+    return sorted(element_types, key=lambda element: (element[1], element[0]))
+
+def corner_case_bytes(num_bytes, seed, element_types, corner_case_ratio=0.5):
+    """Generate inputs mixing per-lane boundary values of an element type with random lanes
+
+    The seed selects one of element_types, and the input is split into lanes of
+    that type. Parameters with that element type then see NaNs, infinities,
+    denormals, INT_MIN, saturation boundaries, etc. in a random subset of lanes.
+    """
+    rng = random.Random(seed)
+    element_type, element_bits = element_types[seed % len(element_types)]
+    corner_cases = element_corner_cases(element_type, element_bits)
+
+    value = 0
+    for lane in range(num_bytes * 8 // element_bits):
+        if rng.random() < corner_case_ratio:
+            lane_bits = rng.choice(corner_cases)
+        else:
+            lane_bits = rng.getrandbits(element_bits)
+        value |= lane_bits << (lane * element_bits)
+
+    return value
+
+def test_inputs(n_input_bits, kind, value, element_types=None, corpus=None):
+    """Input bits of a test as an integer
+
+    kind is "seed" for random inputs, "corner" for corner case inputs, which need
+    element_types, and "index" for edge case inputs. With an InputCorpus, inputs
+    are read from it instead of generated.
+    """
+    if corpus is not None:
+        return corpus.inputs(kind, value)
+
+    num_input_bytes = n_input_bits // 8
+    if kind == "seed":
+        return random_bytes(num_input_bytes, value)
+    elif kind == "corner":
+        return corner_case_bytes(num_input_bytes, value, element_types)
+    elif kind == "index":
+        return combine_test_input_chunks(num_input_bytes, value)
+
+    raise ValueError("Unknown test kind {}".format(kind))
+
+def float_constant_hex(bits):
+    """Format float bits as a LLVM IR float constant, which uses the double format"""
+    sign = bits >> 31
+    exponent = (bits >> 23) & 0xff
+    mantissa = bits & 0x7fffff
+
+    if exponent == 0xff:
+        # Widen infinities and NaNs by hand, as converting through a double quiets signaling NaNs
+        return "0x{:016X}".format((sign << 63) | (0x7ff << 52) | (mantissa << 29))
+
+    const_float = struct.unpack("<f", bits.to_bytes(4, "little"))[0]
+    return "0x" + struct.pack(">d", const_float).hex().upper()
+
+# Versions of the encoding of input bits as element constants of a testbed.
+# Version 1 is the original encoding, which byte-swaps elements and pads short
+# constants with '0' characters, so some bit patterns such as zeros, INT_MIN or
+# NaNs never reach the intrinsic. It is the default so that earlier logs can be
+# reproduced from their seeds. Version 2 passes the input bits exactly, as the
+# shared library harness does.
+ENCODINGS = (1, 2)
+DEFAULT_ENCODING = 1
+
+# Corner case inputs are boundary values of element types, such as INT_MIN or
+# NaN payloads, which only reach the intrinsic unchanged with version 2
+CORNER_CASE_ENCODING = 2
+
+def test_encoding(kind, encoding=None):
+    """Encoding of the testbeds of a test of the given kind, given encoding or None for the default.
+
+    Corner case tests default to CORNER_CASE_ENCODING, and raise ValueError with
+    another encoding, which would mangle the boundary values they test. Other
+    tests default to DEFAULT_ENCODING.
+    """
+    if kind == "corner":
+        if encoding not in (None, CORNER_CASE_ENCODING):
+            raise ValueError("Corner case inputs need encoding {}, encoding {} mangles their boundary values".format(
+                    CORNER_CASE_ENCODING, encoding))
+        return CORNER_CASE_ENCODING
+    return DEFAULT_ENCODING if encoding is None else encoding
+
 def left_pad(base, target_length, pad_char):
     while len(base) < target_length:
         base = pad_char + base
     return base
 
-def make_testbed(intrinsic, properties, n_input_bits, inputs, num_repeat, combination):
-    """Return a string for a LLVM IR program that tests the provided intrinsic on inputs"""
+def element_constant_string(element_type, element_bits, element_constant, encoding=DEFAULT_ENCODING):
+    """Format the input bits of one vector element as a typed LLVM IR constant"""
+    if encoding == 1:
+        const_hex = hex(element_constant)[2:]
+        if len(const_hex) % 2 == 1:
+            const_hex = left_pad(const_hex, len(const_hex) + 1, "0")
+        const_bytes = bytes.fromhex(const_hex)
+        const_bytes = left_pad(const_bytes, element_bits // 8, b"0")
+
+        if element_type == "double":
+            return "{} 0x{}".format(element_type, const_hex)
+        elif element_type == "float":
+            const_float = struct.unpack('f', const_bytes)[0]
+            return "{} 0x{}".format(element_type, struct.pack('>d', const_float).hex())
+        elif element_type[0] == "i":
+            return "{} {}".format(element_type, struct.unpack(type_to_format[element_type], const_bytes)[0])
+    elif encoding == 2:
+        if element_type == "double":
+            return "{} 0x{:016X}".format(element_type, element_constant)
+        elif element_type == "float":
+            return "{} {}".format(element_type, float_constant_hex(element_constant))
+        elif element_type[0] == "i":
+            # Elements hold the input bits as a two's complement integer
+            const_bytes = element_constant.to_bytes(element_bits // 8, "little")
+            return "{} {}".format(element_type, struct.unpack("<" + type_to_format[element_type], const_bytes)[0])
+    else:
+        raise ValueError("Unknown encoding {}".format(encoding))
+
+    raise TypeError("Invalid element type {}".format(element_type))
+
+def make_testbed(intrinsic, properties, n_input_bits, inputs, num_repeat, combination, encoding=DEFAULT_ENCODING):
+    """Return a string for a LLVM IR program that tests the provided intrinsic on inputs
+
+    encoding is the version of the encoding of input bits as constants, see ENCODINGS.
+    """
 
     # Properties and state
     out_dtype, out_width, _, out_element_bits  = get_type(properties["RetTypes"][0])
@@ -132,24 +290,10 @@ def make_testbed(intrinsic, properties, n_input_bits, inputs, num_repeat, combin
                 element_constant = param_constant & element_mask
                 param_constant = param_constant >> param_element_bits
 
-                const_hex = hex(element_constant)[2:]
-                if len(const_hex) % 2 == 1:
-                    const_hex = left_pad(const_hex, len(const_hex) + 1, "0")
-                const_bytes = bytes.fromhex(const_hex)
-                const_bytes = left_pad(const_bytes, param_element_bits // 8, b"0")
-
-                if param_element_type == "double":
-                    element_constants.append("{} 0x{}".format(param_element_type, const_hex))
-                elif param_element_type == "float":
-                    const_float = struct.unpack('f', const_bytes)[0]
-                    const_double_bytes = struct.pack('>d', const_float)
-                    const_double_hex = const_double_bytes.hex()
-                    element_constants.append("{} 0x{}".format(param_element_type, const_double_hex))
-                elif param_element_type[0] == "i":
-                    format_string = type_to_format[param_element_type]
-                    const_value = struct.unpack(format_string, const_bytes)[0]
-                    element_constants.append("{} {}".format(param_element_type, const_value))
-                else:
+                try:
+                    element_constants.append(element_constant_string(param_element_type, param_element_bits,
+                                                                      element_constant, encoding=encoding))
+                except TypeError:
                     raise TypeError("Invalid element type {} for parameter of type: {}".format(param_element_type, param_type))
 
             params.append("{} <{}>".format(param_type, ", ".join(element_constants)))
@@ -243,8 +387,8 @@ attributes #3 = {{ nounwind readnone }}
 
     return testbed
 
-def generate_store_testbed(intrinsic, properties, n_input_bits, inputs):
-    """Generate and store a testbed"""
+def enumerate_configurations(intrinsic, properties, n_input_bits):
+    """Yield (num_repeat, combination) for each configuration of an intrinsic that fits in the input bits"""
     if not (len(properties["RetTypes"]) == 1 and properties["RetTypes"][0]):
         print("{}Skipping intrinsic {} due to bad return types {}{}"\
               .format(Fore.YELLOW, intrinsic, properties["RetTypes"], Style.RESET_ALL),
@@ -273,40 +417,132 @@ def generate_store_testbed(intrinsic, properties, n_input_bits, inputs):
         num_repeat = 2 ** log_num_repeat
 
         for combination in (Combination.HORIZONTAL, Combination.VERTICAL):
-            try:
-                testbed = make_testbed(
-                            intrinsic, properties, n_input_bits, inputs,
-                            num_repeat=num_repeat,
-                            combination=combination)
+            yield num_repeat, combination
 
-                intrinsic_folder = os.path.join("tests", intrinsic, "combo_{}".format(combination.name), "repeat_{}".format(num_repeat))
-                os.makedirs(intrinsic_folder, exist_ok=True)
+def unsupported_reason(properties):
+    """Reason an intrinsic cannot be tested, or None"""
+    if not (len(properties["RetTypes"]) == 1 and properties["RetTypes"][0]):
+        return "bad return types {}".format(properties["RetTypes"])
+
+    for param_type in properties["ParamTypes"]:
+        if not re.match("llvm_v[0-9]+", param_type):
+            return "non-vector param type {}".format(properties["ParamTypes"])
+
+    return None
 
-                with open(os.path.join(intrinsic_folder, "properties.json"), "w") as properties_file:
-                    json.dump(properties, properties_file)
+def generate_store_testbed(intrinsic, properties, n_input_bits, inputs, manifest=None, output_folder="tests",
+                           failures=None, encoding=DEFAULT_ENCODING):
+    """Generate and store a testbed
 
-                with open(os.path.join(intrinsic_folder, "testbed.ll"), "w") as testbed_file:
-                    testbed_file.write(testbed)
-            except TypeError as e:
-                print(e)
+    If a manifest is provided, testbeds are recorded in it rather than in a
+    tests/<intrinsic>/combo_*/repeat_*/ directory tree. Intrinsics and
+    configurations recorded in a FailureCache are skipped, and new generation
+    failures are recorded in it. encoding is passed to make_testbed.
+    """
+    if failures is not None:
+        if failures.failure(intrinsic, properties):
+            return
+        reason = unsupported_reason(properties)
+        if reason:
+            failures.record(intrinsic, properties, "generate", reason)
+
+    for num_repeat, combination in enumerate_configurations(intrinsic, properties, n_input_bits):
+        if failures is not None and failures.failure(config_id(intrinsic, combination, num_repeat), properties):
+            continue
+
+        try:
+            testbed = make_testbed(
+                        intrinsic, properties, n_input_bits, inputs,
+                        num_repeat=num_repeat,
+                        combination=combination,
+                        encoding=encoding)
+
+            if manifest is not None:
+                manifest.add_testbed(intrinsic, properties, combination, num_repeat, testbed)
+                continue
+
+            intrinsic_folder = os.path.join(output_folder, intrinsic, "combo_{}".format(combination.name), "repeat_{}".format(num_repeat))
+            os.makedirs(intrinsic_folder, exist_ok=True)
+
+            with open(os.path.join(intrinsic_folder, "properties.json"), "w") as properties_file:
+                json.dump(properties, properties_file)
+
+            with open(os.path.join(intrinsic_folder, "testbed.ll"), "w") as testbed_file:
+                testbed_file.write(testbed)
+        except TypeError as e:
+            print(e)
+            if failures is not None:
+                failures.record(config_id(intrinsic, combination, num_repeat), properties, "generate", str(e))
 
 if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Generate testbeds for intrinsic equality testing")
+    parser.add_argument("--seed", type=int, required=False, default=0,
+                        help="Seed for the input generator. The default of 0 indicates that edge cases should be generated.")
+    parser.add_argument("--test-index", type=int, required=False, default=0,
+                        help="Index of generated test (made of specific byte chunks)")
+    parser.add_argument("--max-bits", type=int, default=2048,
+                        help="Maximum number of bits to generate for inputs")
+    parser.add_argument("--corner-cases", action="store_true",
+                        help="With --seed, mix boundary values of a parameter element type into random inputs")
+    parser.add_argument("--corpus", type=str, default=None,
+                        help="Read the input of the seed or test index from a corpus built by input_corpus.py")
+    parser.add_argument("--output-folder", type=str, default="tests",
+                        help="Folder in which to store testbeds, e.g. a folder on a tmpfs")
+    parser.add_argument("--encoding", type=int, choices=ENCODINGS, default=None,
+                        help="Version of the encoding of input bits as constants. 1 reproduces earlier logs, "
+                             "2 passes the input bits exactly (default: 2 with --corner-cases, which requires it, "
+                             "1 otherwise)")
+    parser.add_argument("--layout", choices=["manifest", "tree"], default="manifest",
+                        help="Store testbeds in one folder indexed by a manifest, or in a directory tree per configuration")
+    #parser.add_argument("--shuffle-input", type=int, default=0x000102030405060708090A0B0C0D0E0F101112131415161718191A1B1C1D1E1F02122232425262728292A2B2C2D2E2F303132333435363738393A3B3C3D3E3F404142434445464748494A4B4C4D4E4F505152535455565758595A5B5C5D5E5F)
+    failure_cache.add_arguments(parser)
+    args = parser.parse_args()
+
     intel_vector = {}
 
     with open("intrinsics_all.json") as intrinsics_file:
         intrinsics = json.load(intrinsics_file)
         intel_vector = record_utils.filter_intel_vector(intrinsics)
 
-    num_input_bytes = args.max_bits // 8
-
-    if args.seed:
-        inputs = random_bytes(num_input_bytes, args.seed)
-    else:
-        inputs = combine_test_input_chunks(num_input_bytes, args.test_index)
-
+    corpus = None
+    if args.corpus:
+        from input_corpus import InputCorpus
+
+        corpus = InputCorpus(args.corpus)
+
+    kind = ("corner" if args.corner_cases else "seed") if args.seed else "index"
+    try:
+        encoding = test_encoding(kind, args.encoding)
+    except ValueError as e:
+        parser.error(str(e))
+    inputs = test_inputs(args.max_bits, kind, args.seed or args.test_index,
+                         element_types=input_element_types(intel_vector) if kind == "corner" else None,
+                         corpus=corpus)
+
+    manifest = None
+    if args.layout == "manifest":
+        manifest = Manifest(args.output_folder, inputs={
+            "seed": args.seed,
+            "test_index": args.test_index,
+            "corner_cases": args.corner_cases,
+            "corpus": args.corpus,
+            "max_bits": args.max_bits,
+            "encoding": encoding,
+        })
+
+    failures = failure_cache.from_arguments(args)
     for intrinsic in sorted(intel_vector.keys()):
         properties = intel_vector[intrinsic]
         generate_store_testbed(intrinsic=intrinsic,
                                properties=properties,
                                n_input_bits=args.max_bits,
-                               inputs=inputs)
+                               inputs=inputs,
+                               manifest=manifest,
+                               output_folder=args.output_folder,
+                               failures=failures,
+                               encoding=encoding)
+
+    if manifest is not None:
+        manifest.save()
+    if failures is not None:
+        failures.save()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import json
+
+import numpy as np
+
+from generate_tests import corner_case_bytes, input_element_types, test_byte_chunks
+import record_utils
+
+
+# Key of the counter-based generator for random rows. Row s of the stream is the
+# input of seed s, so changing this key changes every random input.
+CORPUS_KEY = 0x696e7472616e7369
+
+
+def random_rows(first_seed, count, num_bytes):
+    """Return a (count, num_bytes) uint8 array of random inputs for consecutive seeds.
+
+    Inputs come from one Philox stream, in which each seed owns a fixed block of
+    counters. Any seed is generated directly by advancing the counter, without
+    generating the inputs of earlier seeds.
+    """
+    # Each Philox4x64 counter step yields four 64-bit words
+    steps_per_row = -(-num_bytes // 32)
+    bit_generator = np.random.Philox(key=CORPUS_KEY)
+    bit_generator.advance(first_seed * steps_per_row)
+
+    words = bit_generator.random_raw(count * steps_per_row * 4)
+    return words.view(np.uint8).reshape(count, steps_per_row * 32)[:, :num_bytes]
+
+
+def test_index_rows(first_index, count, num_bytes):
+    """Return a (count, num_bytes) uint8 array of edge case inputs, as combine_test_input_chunks"""
+    combinations = itertools.combinations_with_replacement(test_byte_chunks, num_bytes // 8)
+
+    rows = []
+    for chunks in itertools.islice(combinations, first_index, first_index + count):
+        rows.append(int("".join(chunks), 16).to_bytes(num_bytes, "little"))
+
+    if len(rows) < count:
+        raise IndexError("Test index {} out of range".format(first_index + count - 1))
+    return np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(count, num_bytes)
+
+
+def corner_case_rows(first_seed, count, num_bytes, element_types):
+    """Return a (count, num_bytes) uint8 array of corner case inputs, as corner_case_bytes"""
+    rows = [corner_case_bytes(num_bytes, seed, element_types).to_bytes(num_bytes, "little")
+            for seed in range(first_seed, first_seed + count)]
+    return np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(count, num_bytes)
+
+
+def build_corpus(path, n_input_bits, seeds=None, test_indices=None, corner_case_seeds=None, element_types=None):
+    """Generate inputs for ranges of seeds, edge case indices and corner case seeds into a memory-mapped matrix.
+
+    Writes <path>.npy with one row of input bytes per test, and <path>.json
+    recording which rows hold which (kind, first, last) range.
+    """
+    num_bytes = n_input_bits // 8
+    sections = []
+    row = 0
+    for kind, test_range in (("seed", seeds), ("index", test_indices), ("corner", corner_case_seeds)):
+        if test_range:
+            sections.append({"kind": kind, "first": test_range[0], "last": test_range[1], "row": row})
+            row += test_range[1] - test_range[0] + 1
+
+    matrix = np.lib.format.open_memmap(path + ".npy", mode="w+", dtype=np.uint8, shape=(row, num_bytes))
+    for section in sections:
+        count = section["last"] - section["first"] + 1
+        if section["kind"] == "seed":
+            rows = random_rows(section["first"], count, num_bytes)
+        elif section["kind"] == "index":
+            rows = test_index_rows(section["first"], count, num_bytes)
+        elif section["kind"] == "corner":
+            rows = corner_case_rows(section["first"], count, num_bytes, element_types)
+        matrix[section["row"]:section["row"] + count] = rows
+    matrix.flush()
+
+    with open(path + ".json", "w") as index_f:
+        json.dump({"max_bits": n_input_bits, "sections": sections}, index_f)
+
+    return InputCorpus(path)
+
+
+class InputCorpus(object):
+    """Read-only view of a corpus written by build_corpus.
+
+    Rows are memory-mapped, so slices passed to testbed generators or the
+    shared-library harness are read from the page cache without copying.
+    """
+
+    def __init__(self, path):
+        with open(path + ".json", "r") as index_f:
+            index = json.load(index_f)
+
+        self.max_bits = index["max_bits"]
+        self.sections = index["sections"]
+        self.rows = np.load(path + ".npy", mmap_mode="r")
+
+    def row(self, kind, value):
+        """Row number holding the input of a seed ("seed"), edge case index ("index") or corner case seed ("corner")"""
+        for section in self.sections:
+            if section["kind"] == kind and section["first"] <= value <= section["last"]:
+                return section["row"] + value - section["first"]
+
+        raise IndexError("Corpus has no input for {} {}".format(kind, value))
+
+    def inputs(self, kind, value):
+        """Input bits of a test as an integer, in the format generate_tests.py uses"""
+        return int.from_bytes(self.rows[self.row(kind, value)].tobytes(), "little")
+
+    def tests(self):
+        """List of (kind, value) for every row, in row order"""
+        tests = []
+        for section in self.sections:
+            tests.extend((section["kind"], value) for value in range(section["first"], section["last"] + 1))
+        return tests
+
+    def __len__(self):
+        return self.rows.shape[0]
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Generate a memory-mapped corpus of test inputs")
+    parser.add_argument("path", type=str,
+                        help="Path prefix of the corpus (.npy and .json files are written)")
+    parser.add_argument("--max-bits", type=int, default=2048,
+                        help="Number of bits per input")
+    parser.add_argument("--seeds", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="Inclusive range of random input seeds")
+    parser.add_argument("--test-indices", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="Inclusive range of edge case test indices")
+    parser.add_argument("--corner-case-seeds", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="Inclusive range of seeds for type-aware corner case inputs")
+    args = parser.parse_args()
+
+    element_types = None
+    if args.corner_case_seeds:
+        with open("intrinsics_all.json") as intrinsics_file:
+            element_types = input_element_types(record_utils.filter_intel_vector(json.load(intrinsics_file)))
+
+    corpus = build_corpus(args.path, args.max_bits,
+                          seeds=args.seeds,
+                          test_indices=args.test_indices,
+                          corner_case_seeds=args.corner_case_seeds,
+                          element_types=element_types)
+    print("Wrote {} inputs of {} bytes to {}.npy".format(len(corpus), args.max_bits // 8, args.path))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Library interface to generating, building, running and analyzing testbeds.
+
+The command line scripts each load intrinsics_all.json and run one step for
+one input. These entry points let a single process drive a whole range of
+tests instead, reusing the loaded intrinsic records and parsed types:
+
+    import intransitive
+
+    equivalences, num_tests = intransitive.run_tests([("seed", s) for s in range(1, 101)])
+    equivalence_lists, missed_list, conversions = intransitive.analyze(equivalences, num_tests, "logs")
+    intransitive.emit_header(conversions, "gen/IntrinsicConversion.h", format="table")
+"""
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import os
+import shutil
+
+from generate_tests import enumerate_configurations, generate_store_testbed, input_element_types, test_encoding, test_inputs
+import record_utils
+from testbed_manifest import Manifest
+from testbed_runner import build_testbed, run_testbed
+
+
+INTRINSICS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intrinsics_all.json")
+
+
+@functools.lru_cache(maxsize=None)
+def load_intrinsics(path=INTRINSICS_PATH):
+    """Intel vector intrinsic records, loaded once per process. The returned dict is shared, do not modify it"""
+    with open(path, "r") as intrinsics_file:
+        return record_utils.filter_intel_vector(json.load(intrinsics_file))
+
+
+def configurations(intrinsics, n_input_bits):
+    """List (intrinsic, properties, combination, repeat) of every configuration that fits in the input bits"""
+    result = []
+    for intrinsic in sorted(intrinsics):
+        properties = intrinsics[intrinsic]
+        for num_repeat, combination in enumerate_configurations(intrinsic, properties, n_input_bits):
+            result.append((intrinsic, properties, combination, num_repeat))
+    return result
+
+
+def generate(folder, kind="seed", value=0, n_input_bits=2048, intrinsics=None, corpus=None, failures=None,
+             encoding=None):
+    """Generate the testbeds of one test into folder, as generate_tests.py. Returns the saved Manifest
+
+    Intrinsics and configurations recorded in failures, a FailureCache, are skipped,
+    and new generation failures are recorded in it. encoding defaults as in
+    generate_tests.test_encoding.
+    """
+    intrinsics = intrinsics or load_intrinsics()
+    encoding = test_encoding(kind, encoding)
+    element_types = input_element_types(intrinsics) if kind == "corner" else None
+    inputs = test_inputs(n_input_bits, kind, value, element_types=element_types, corpus=corpus)
+
+    manifest = Manifest(folder, inputs={"kind": kind, "value": value, "max_bits": n_input_bits, "encoding": encoding})
+    for intrinsic in sorted(intrinsics):
+        generate_store_testbed(intrinsic, intrinsics[intrinsic], n_input_bits, inputs, manifest=manifest,
+                               failures=failures, encoding=encoding)
+
+    manifest.save()
+    return manifest
+
+
+def build(manifest, llc="llc", jobs=None, failures=None):
+    """Build every testbed of a manifest in parallel, recording failures. Returns the IDs of the testbeds that were built"""
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        results = list(executor.map(lambda identifier: build_testbed(manifest.artifact_path(identifier), llc=llc),
+                                    manifest))
+
+    built = []
+    for identifier, failure in zip(manifest, results):
+        if failure is None:
+            built.append(identifier)
+        elif failures is not None:
+            failures.record(identifier, manifest.configuration(identifier)[1], *failure)
+    return built
+
+
+def run(manifest, failures=None):
+    """Run every built testbed of a manifest, and group testbed names by output as find_common_outputs"""
+    output_to_intrinsics = defaultdict(list)
+    for identifier in manifest:
+        path = manifest.artifact_path(identifier)
+        if not os.path.exists(path):
+            continue
+
+        output, reason = run_testbed(path)
+        if reason is not None:
+            # Partial output of a testbed that crashed says nothing about equivalence
+            if failures is not None:
+                failures.record(identifier, manifest.configuration(identifier)[1], "run", reason)
+            continue
+        output = "".join(line.strip() for line in output.splitlines())
+        output_to_intrinsics[output].append(manifest.configurations[identifier]["name"])
+
+    return list(output_to_intrinsics.values())
+
+
+def run_tests(tests, folder="tests", n_input_bits=2048, llc="llc", jobs=None, corpus=None, monitor=None,
+              equivalences=None, keep_artifacts=False, failures=None, encoding=None):
+    """Generate, build and run each (kind, value) test in turn, refining equivalences with each.
+
+    Testbeds of a test are built in folder/<kind><value>, and deleted after they
+    have run unless keep_artifacts is set. With a ConvergenceMonitor, stops once it
+    has converged. With a FailureCache, configurations that failed for an earlier
+    test are skipped. Returns (equivalences, number of tests refined).
+    """
+    from find_identical_intrinsics import refine_equivalences
+
+    intrinsics = load_intrinsics()
+    if equivalences is None:
+        equivalences = {}
+
+    num_tests = 0
+    for kind, value in tests:
+        test_folder = os.path.join(folder, "{}{}".format(kind, value))
+        manifest = generate(test_folder, kind, value, n_input_bits, intrinsics=intrinsics, corpus=corpus,
+                            failures=failures, encoding=encoding)
+        build(manifest, llc=llc, jobs=jobs, failures=failures)
+        refine_equivalences(equivalences, run(manifest, failures=failures))
+        num_tests += 1
+
+        if failures is not None:
+            failures.save()
+
+        if not keep_artifacts:
+            shutil.rmtree(test_folder, ignore_errors=True)
+
+        if monitor is not None:
+            monitor.update(equivalences, 1)
+            if monitor.converged():
+                break
+
+    return equivalences, num_tests
+
+
+def analyze(equivalences, num_tests, output_folder):
+    """Write equivalences, missed configurations and conversions as find_identical_intrinsics.py.
+
+    Returns (equivalence_lists, missed_list, conversions).
+    """
+    from find_identical_intrinsics import report_equivalences
+
+    os.makedirs(output_folder, exist_ok=True)
+    return report_equivalences(equivalences, num_tests, output_folder, intrinsics=load_intrinsics())
+
+
+def emit_header(conversions, output=None, format="map"):
+    """Return the source of IntrinsicConversion.h for conversions, and write it to output if given.
+
+    conversions are Configuration pairs from analyze, or dicts as in test_conversions.json.
+    """
+    from generate_intrinsic_map import make_map_source, make_table_source
+
+    conversions = [[configuration if isinstance(configuration, dict) else configuration.to_dict()
+                    for configuration in conversion]
+                   for conversion in conversions]
+    if format == "table":
+        source = make_table_source(conversions)
+    else:
+        source = make_map_source(conversions)
+
+    if output:
+        with open(output, "w") as output_f:
+            output_f.write(source)
+    return source
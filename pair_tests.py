@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import subprocess
+import sys
+
+from colorama import Fore, Style
+from jinja2 import Template
+import numpy as np
+
+import failure_cache
+import record_utils
+from shared_harness import build_library, function_symbol, output_bytes
+from testbed_manifest import Manifest
+from verify_conversions import (add_input_arguments, concrete_configurations, conversion_intrinsics,
+                                inputs_from_arguments, write_header, write_results)
+
+
+PAIRS_FILENAME = "pairs.json"
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "pair_test.c.tmpl")
+
+
+def make_pair_source(bases, target, input_bytes, num_output_bytes):
+    """Return the C source of a program checking base configuration IDs against a target configuration ID"""
+    with open(TEMPLATE_PATH, "r") as template_f:
+        template = Template(template_f.read())
+
+    return template.render(
+        bases=bases,
+        target=target,
+        input_bytes=input_bytes,
+        output_bytes=num_output_bytes,
+        symbols=[function_symbol(identifier) for identifier in sorted(set(bases + [target]))],
+        target_symbol=function_symbol(target),
+        base_symbols=[(identifier, function_symbol(identifier)) for identifier in bases])
+
+
+def build_pairs(folder, conversions, intrinsics, n_input_bits, llc="llc", cc="gcc", jobs=None):
+    """Build one self-checking program per conversion.
+
+    Each program links the base configurations (k calls of the narrow intrinsic)
+    and the target configuration (one call of the wide intrinsic), compiled as for
+    the shared library harness, runs them on the same input rows and compares
+    their outputs itself. Conversions that cannot be checked get no program.
+    Returns the pairs written to pairs.json.
+    """
+    identifiers = set()
+    for base, target in conversions:
+        identifiers.update(concrete_configurations(base) + concrete_configurations(target))
+    manifest = build_library(folder, intrinsics, n_input_bits, llc=llc, cc=cc, configurations=identifiers)
+
+    pairs = []
+    for index, (base, target) in enumerate(conversions):
+        bases = concrete_configurations(base)
+        target_identifier = concrete_configurations(target)[0]
+        pair = {"base": base, "target": target, "program": None, "status": None, "reason": None}
+        pairs.append(pair)
+
+        missing = [identifier for identifier in bases + [target_identifier] if identifier not in manifest.configurations]
+        if missing:
+            pair["status"], pair["reason"] = "missing", "{} was not built".format(missing[0])
+            continue
+
+        sizes = set(output_bytes(manifest.configuration(identifier)[1], manifest.configuration(identifier)[3])
+                    for identifier in bases + [target_identifier])
+        if len(sizes) > 1:
+            pair["status"], pair["reason"] = "broken", "{} and {} write different numbers of bytes".format(
+                    bases[0], target_identifier)
+            continue
+
+        pair["program"] = os.path.join(folder, "pairs", "pair{}".format(index))
+        pair["configurations"] = bases + [target_identifier]
+        os.makedirs(os.path.dirname(pair["program"]), exist_ok=True)
+        with open(pair["program"] + ".c", "w") as source_f:
+            source_f.write(make_pair_source(bases, target_identifier, n_input_bits // 8, sizes.pop()))
+
+    def link(pair):
+        objects = [manifest.artifact_path(identifier, ".o") for identifier in sorted(set(pair["configurations"]))]
+        result = subprocess.run([cc, "-O2", pair["program"] + ".c"] + objects + ["-o", pair["program"]],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            pair["program"] = None
+            pair["status"], pair["reason"] = "missing", "failed to link: {}".format(
+                    failure_cache.error_summary(result.stderr.decode(errors="replace"),
+                                                failure_cache.exit_reason(result.returncode)))
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        list(executor.map(link, [pair for pair in pairs if pair["program"]]))
+
+    with open(os.path.join(folder, PAIRS_FILENAME), "w") as pairs_f:
+        json.dump(pairs, pairs_f, indent=1)
+    return pairs
+
+
+def load_pairs(folder):
+    with open(os.path.join(folder, PAIRS_FILENAME), "r") as pairs_f:
+        return json.load(pairs_f)
+
+
+def run_pair(pair, inputs, tests):
+    """Run the program of a pair on input rows. Returns (status, reason) as verify_conversions"""
+    if pair["program"] is None:
+        return pair["status"], pair["reason"]
+
+    result = subprocess.run([os.path.abspath(pair["program"])], input=inputs, stdout=subprocess.PIPE)
+    lines = result.stdout.decode(errors="replace").splitlines()
+    verdict = lines[0].split() if lines else []
+
+    if result.returncode == 0 and verdict == ["PASS", str(len(tests))]:
+        return "confirmed", None
+    elif (result.returncode == 1 and len(verdict) == 3 and verdict[0] == "FAIL" and verdict[1].isdigit()
+          and int(verdict[1]) < len(tests) and len(lines) >= 4):
+        # The first counterexample: input row, base output and target output
+        kind, value = tests[int(verdict[1])]
+        return "broken", "{} and {} differ on {} {}: {} != {}".format(
+                verdict[2], pair["configurations"][-1], kind, value, lines[2], lines[3])
+
+    return "broken", "unexpected output {!r} of {} ({})".format(
+            lines[0] if lines else "", pair["program"], failure_cache.exit_reason(result.returncode))
+
+
+def run_pairs(pairs, inputs, tests, jobs=None):
+    """Run every pair on inputs, a (count, input_bytes) uint8 array with one row per test"""
+    inputs = np.ascontiguousarray(inputs, dtype=np.uint8).tobytes()
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        return list(executor.map(lambda pair: run_pair(pair, inputs, tests), pairs))
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Check candidate conversions with self-checking differential programs")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser("build", help="Build one program per conversion")
+    build_parser.add_argument("folder", type=str,
+                              help="Folder in which to store the programs and pairs.json")
+    build_parser.add_argument("--conversions", type=str, default="logs/test_conversions.json",
+                              help="Conversions to check, as written by find_identical_intrinsics.py")
+    build_parser.add_argument("--max-bits", type=int, default=2048,
+                              help="Number of bits per input")
+    build_parser.add_argument("--llc", type=str, default="llc",
+                              help="Path to llc")
+    build_parser.add_argument("--jobs", type=int, default=None,
+                              help="Concurrent gcc processes (default: number of CPUs)")
+
+    run_parser = subparsers.add_parser("run", help="Run every program on inputs, printing only failures")
+    run_parser.add_argument("folder", type=str,
+                            help="Folder containing the programs built by the build command")
+    add_input_arguments(run_parser)
+    run_parser.add_argument("--jobs", type=int, default=None,
+                            help="Concurrently running programs (default: number of CPUs)")
+    run_parser.add_argument("--output-folder", type=str, default="logs",
+                            help="Folder in which to write verified_conversions.json and broken_conversions.json")
+    run_parser.add_argument("--header", type=str, default=None,
+                            help="Regenerate IntrinsicConversion.h at this path from the confirmed conversions only")
+    run_parser.add_argument("--format", choices=["map", "table"], default="map",
+                            help="Header format, as for generate_intrinsic_map.py")
+    args = parser.parse_args()
+
+    with open("intrinsics_all.json") as intrinsics_file:
+        intel_vector = record_utils.filter_intel_vector(json.load(intrinsics_file))
+
+    if args.command == "build":
+        with open(args.conversions, "r") as conversions_f:
+            conversions = json.load(conversions_f)
+
+        pairs = build_pairs(args.folder, conversions, conversion_intrinsics(conversions, intel_vector), args.max_bits,
+                            llc=args.llc, jobs=args.jobs)
+        print("Built {} programs for {} conversions".format(sum(1 for pair in pairs if pair["program"]), len(pairs)),
+              file=sys.stderr)
+    elif args.command == "run":
+        max_bits = Manifest.load(args.folder).inputs["max_bits"]
+        if args.max_bits != max_bits:
+            parser.error("programs in {} were built for --max-bits {}".format(args.folder, max_bits))
+
+        pairs = load_pairs(args.folder)
+        tests, inputs_fn = inputs_from_arguments(args, intel_vector)
+        results = run_pairs(pairs, inputs_fn(tests), tests, jobs=args.jobs)
+
+        conversions = [[pair["base"], pair["target"]] for pair in pairs]
+        confirmed = write_results(conversions, results, args.output_folder)
+        print("{}{} of {} conversions confirmed on {} inputs{}".format(
+                  Fore.GREEN if len(confirmed) == len(conversions) else Fore.YELLOW,
+                  len(confirmed), len(conversions), len(tests), Style.RESET_ALL),
+              file=sys.stderr)
+
+        if args.header:
+            write_header(confirmed, args.header, args.format)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import os
+import shutil
+import sys
+import time
+
+from colorama import Fore, Style
+
+from generate_tests import ENCODINGS, input_element_types, make_testbed, test_encoding, test_inputs
+import conversion_db
+import convergence
+import failure_cache
+from input_corpus import InputCorpus
+from intransitive import configurations
+import record_utils
+import scheduler
+from testbed_manifest import BUILD_STAGES, Manifest, config_id
+import testbed_runner
+
+
+STAGES = ("generate", "llc", "as", "link", "run")
+
+
+class Pipeline(object):
+    """Stream every configuration of every test through generate, llc, as, link and run.
+
+    Instead of finishing each stage for all testbeds before starting the next,
+    each configuration moves to its next stage as soon as the previous one
+    finishes, so compilation, execution and refinement overlap. Each stage has
+    its own concurrency limit, and runs in worker threads, so the event loop
+    only schedules. At most max_in_flight configurations are started and not
+    yet run, so generation cannot run ahead of the compilers.
+    With a TimingHistory, configurations start slowest first, and the time each
+    takes per stage is recorded.
+    """
+
+    def __init__(self, intrinsics, n_input_bits, tests_folder, llc="llc", jobs=None, run_jobs=None,
+                 max_in_flight=None, keep_artifacts=False, corpus=None, failures=None, timings=None,
+                 encoding=None):
+        self.n_input_bits = n_input_bits
+        self.tests_folder = tests_folder
+        self.llc = llc
+        self.keep_artifacts = keep_artifacts
+        self.corpus = corpus
+        self.failures = failures
+        self.timings = timings
+        self.encoding = encoding
+        self.element_types = input_element_types(intrinsics)
+
+        jobs = jobs or os.cpu_count()
+        self.stage_limits = {"generate": 1, "llc": jobs, "as": jobs, "link": jobs, "run": run_jobs or jobs}
+        self.max_in_flight = max_in_flight or 4 * jobs
+
+        self.configurations = configurations(intrinsics, n_input_bits)
+        if timings is not None:
+            work = {config_id(intrinsic, combination, num_repeat): scheduler.configuration_work(properties, num_repeat)
+                    for intrinsic, properties, combination, num_repeat in self.configurations}
+            cost = defaultdict(float)
+            for stage in scheduler.STAGES:
+                for identifier, seconds in timings.estimates(stage, work).items():
+                    cost[identifier] += seconds
+            self.configurations.sort(
+                key=lambda configuration: -cost[config_id(configuration[0], configuration[2], configuration[3])])
+
+    async def run_stage(self, stage, identifier, function, *args):
+        """Call function(*args) in a worker thread once the stage has a free slot, off the event loop"""
+        async with self.semaphores[stage]:
+            start = time.monotonic()
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+            if self.timings is not None:
+                self.timings.record(identifier, stage, time.monotonic() - start)
+            return result
+
+    def generate_testbed(self, manifest, inputs, encoding, configuration):
+        """Generate the testbed of a configuration into manifest. Returns None, or the reason it cannot be generated"""
+        intrinsic, properties, combination, num_repeat = configuration
+        try:
+            testbed = make_testbed(intrinsic, properties, self.n_input_bits, inputs,
+                                   num_repeat=num_repeat,
+                                   combination=combination,
+                                   encoding=encoding)
+        except TypeError as e:
+            print(e)
+            return str(e)
+        manifest.add_testbed(intrinsic, properties, combination, num_repeat, testbed)
+        return None
+
+    async def run_configuration(self, manifest, inputs, encoding, configuration):
+        """Generate, build and run one configuration. Returns its output, or None if a stage failed"""
+        intrinsic, properties, combination, num_repeat = configuration
+        try:
+            if self.failures is not None and self.failures.failure(config_id(intrinsic, combination, num_repeat),
+                                                                   properties):
+                return None
+
+            identifier = config_id(intrinsic, combination, num_repeat)
+            reason = await self.run_stage("generate", identifier, self.generate_testbed, manifest, inputs, encoding,
+                                          configuration)
+            if reason is not None:
+                self.record_failure(identifier, properties, "generate", reason)
+                return None
+
+            path = manifest.artifact_path(identifier)
+            for stage, _, __ in BUILD_STAGES:
+                reason = await self.run_stage(stage, identifier, testbed_runner.build_stage, stage, path, self.llc)
+                if reason is not None:
+                    self.record_failure(identifier, properties, stage, reason)
+                    return None
+
+            output, reason = await self.run_stage("run", identifier, testbed_runner.run_testbed, path)
+            if reason is not None:
+                self.record_failure(identifier, properties, "run", reason)
+                return None
+            return identifier, "".join(line.strip() for line in output.splitlines())
+        finally:
+            self.in_flight.release()
+
+    def record_failure(self, identifier, properties, stage, reason):
+        if self.failures is not None:
+            self.failures.record(identifier, properties, stage, reason)
+
+    async def run_test(self, kind, value, tasks, manifest, log_folder):
+        """Wait for every configuration of a test, and group configurations by output"""
+        outputs = [result for result in await asyncio.gather(*tasks) if result is not None]
+
+        output_to_intrinsics = defaultdict(list)
+        for identifier, output in sorted(outputs):
+            output_to_intrinsics[output].append(manifest.configurations[identifier]["name"])
+
+        if log_folder:
+            # Same format as `make run-testbeds`, for find_identical_intrinsics.py
+            log_path = os.path.join(log_folder, "testbeds_{}{}.log".format(kind, value))
+            with open(log_path, "w") as log_file:
+                for identifier, output in sorted(outputs):
+                    log_file.write("TEST START {}\n{}\nTEST STOP\n\n".format(
+                        manifest.configurations[identifier]["name"], output))
+
+        if self.failures is not None:
+            self.failures.save()
+        if self.timings is not None:
+            self.timings.save()
+
+        if self.keep_artifacts:
+            manifest.save()
+        else:
+            shutil.rmtree(manifest.folder, ignore_errors=True)
+
+        return kind, value, list(output_to_intrinsics.values())
+
+    async def run(self, tests, equivalences, monitor, log_folder=None):
+        """Run tests, refining equivalences with each test as soon as all its configurations have run.
+
+        Stops starting new tests once the monitor has converged. Tests already
+        started are still refined in. If a test fails, no new tests are started,
+        and its exception is raised once the tests already started have finished.
+        Returns the number of tests refined.
+        """
+        from find_identical_intrinsics import refine_equivalences
+
+        self.semaphores = {stage: asyncio.Semaphore(self.stage_limits[stage]) for stage in STAGES}
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        # Enough threads for every stage to use all of its slots
+        self.executor = ThreadPoolExecutor(max_workers=sum(self.stage_limits.values()))
+
+        pending = set()
+        num_tests = 0
+        errors = []
+
+        def refine(kind, value, test_task):
+            nonlocal num_tests
+            try:
+                _, __, candidate_equivalences = test_task.result()
+                refine_equivalences(equivalences, candidate_equivalences)
+                num_tests += 1
+                monitor.update(equivalences, 1)
+            except Exception as e:
+                # asyncio only logs exceptions of done callbacks, so run() raises it instead
+                print("{}{} {} failed, stopping: {!r}{}".format(Fore.RED, kind, value, e, Style.RESET_ALL),
+                      file=sys.stderr)
+                errors.append(e)
+                return
+
+            print("{} {:6} | {}".format(kind, value, monitor.summary()), file=sys.stderr)
+
+        for kind, value in tests:
+            if errors:
+                break
+            if monitor.converged():
+                print("Converged, skipping remaining tests", file=sys.stderr)
+                break
+
+            inputs = test_inputs(self.n_input_bits, kind, value, element_types=self.element_types, corpus=self.corpus)
+            encoding = test_encoding(kind, self.encoding)
+            manifest = Manifest(os.path.join(self.tests_folder, "{}{}".format(kind, value)),
+                                inputs={"kind": kind, "value": value, "max_bits": self.n_input_bits,
+                                        "encoding": encoding})
+
+            tasks = []
+            for configuration in self.configurations:
+                # Backpressure: wait until a configuration in flight has run
+                await self.in_flight.acquire()
+                tasks.append(asyncio.ensure_future(self.run_configuration(manifest, inputs, encoding, configuration)))
+
+            test_task = asyncio.ensure_future(self.run_test(kind, value, tasks, manifest, log_folder))
+            test_task.add_done_callback(functools.partial(refine, kind, value))
+            pending.add(test_task)
+            pending = set(task for task in pending if not task.done())
+
+        if pending:
+            await asyncio.wait(pending)
+        self.executor.shutdown()
+
+        if errors:
+            raise errors[0]
+        return num_tests
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Generate, build and run testbeds in an overlapping pipeline")
+    testbed_runner.add_test_arguments(parser)
+    parser.add_argument("--corpus", type=str, default=None,
+                        help="Read inputs from a corpus built by input_corpus.py")
+    parser.add_argument("--max-bits", type=int, default=2048,
+                        help="Maximum number of bits per input")
+    parser.add_argument("--encoding", type=int, choices=ENCODINGS, default=None,
+                        help="Version of the encoding of input bits as constants, as for generate_tests.py "
+                             "(default: 2 for corner case seeds, which require it, 1 otherwise)")
+    parser.add_argument("--tests", type=str, default="tests",
+                        help="Folder in which to build testbeds, e.g. a folder on a tmpfs")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Concurrent llc, as and link processes per stage (default: number of CPUs)")
+    parser.add_argument("--run-jobs", type=int, default=None,
+                        help="Concurrently running testbeds (default: --jobs)")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="Configurations generated but not yet run (default: 4 x --jobs)")
+    parser.add_argument("--keep-artifacts", action="store_true",
+                        help="Keep the testbeds of each test instead of deleting them once it has run")
+    parser.add_argument("--output-folder", type=str, default="logs",
+                        help="Folder in which to store test logs and equivalences")
+    convergence.add_arguments(parser)
+    conversion_db.add_arguments(parser)
+    failure_cache.add_arguments(parser)
+    scheduler.add_arguments(parser)
+    args = parser.parse_args()
+
+    import coloredlogs
+    from find_identical_intrinsics import report_equivalences
+
+    coloredlogs.install()
+
+    with open("intrinsics_all.json") as intrinsics_file:
+        intel_vector = record_utils.filter_intel_vector(json.load(intrinsics_file))
+
+    corpus = None
+    if args.corpus:
+        corpus = InputCorpus(args.corpus)
+        assert corpus.max_bits == args.max_bits
+
+    tests = testbed_runner.tests_from_arguments(args)
+    if not tests:
+        print("{}No tests given, use --seeds, --corner-case-seeds or --test-indices{}".format(Fore.RED, Style.RESET_ALL),
+              file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        encodings = {kind: test_encoding(kind, args.encoding) for kind in set(kind for kind, _ in tests)}
+    except ValueError as e:
+        parser.error(str(e))
+
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    pipeline = Pipeline(intel_vector, args.max_bits, args.tests, llc=args.llc, jobs=args.jobs, run_jobs=args.run_jobs,
+                        max_in_flight=args.max_in_flight, keep_artifacts=args.keep_artifacts, corpus=corpus,
+                        failures=failure_cache.from_arguments(args),
+                        timings=scheduler.from_arguments(args) if args.timings else None,
+                        encoding=args.encoding)
+    equivalences = {}
+    monitor = convergence.from_arguments(args)
+    num_tests = asyncio.run(pipeline.run(tests, equivalences, monitor, log_folder=args.output_folder))
+
+    results = report_equivalences(equivalences, num_tests, args.output_folder)
+    conversion_db.record_from_arguments(args, results, num_tests, llc=args.llc,
+                                        provenance={"tests": testbed_runner.test_ranges(tests[:num_tests]), "corpus": args.corpus,
+                                                    "encoding": encodings})
@@ -35,6 +35,14 @@ def intrinsic_name_to_ir(name):
 
     return "llvm." + ".".join(name.split("_"))
 
+def intrinsic_id_key(name, properties):
+    """Key ordering intrinsic records as TableGen numbers Intrinsic::ID.
+
+    Intrinsics are sorted by target prefix, then by IR name, which is LLVMName
+    when the record sets one and is otherwise derived from the record name.
+    """
+    return (properties.get("TargetPrefix", ""), properties.get("LLVMName") or intrinsic_name_to_ir(name))
+
 def filter(pattern, records):
     return {key: value for key, value in records.items()
                        if re.match(pattern, key)}
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+import sys
+import time
+
+from colorama import Fore, Style
+from tqdm import tqdm
+
+import failure_cache
+from testbed_manifest import BUILD_STAGES, Manifest
+import testbed_runner
+from utilities import get_type
+
+
+STAGES = [stage for stage, _, __ in BUILD_STAGES] + ["run"]
+
+# Weight of the latest timing in the running average of a configuration
+SMOOTHING = 0.5
+
+# Seconds per byte of work assumed for a stage without any history, about that of llc
+DEFAULT_SECONDS_PER_WORK = 1e-4
+
+
+def configuration_work(properties, repeat):
+    """Bytes of parameters and results a configuration moves, a proxy for its cost without history"""
+    num_bytes = 0
+    for type_name in properties["ParamTypes"] + properties["RetTypes"]:
+        try:
+            _, width, __, element_bits = get_type(type_name)
+        except TypeError:
+            continue
+        num_bytes += width * element_bits // 8
+    return repeat * max(num_bytes, 1)
+
+
+class TimingHistory(object):
+    """Per-configuration compile and run times from earlier tests.
+
+    Times are stored per configuration ID and stage as a running average, as
+    configurations take about as long to build and run whatever their inputs.
+    Configurations without history are estimated from the average time per byte
+    of work of the stage, so new intrinsics are still scheduled by size.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.timings = {}
+        if path and os.path.exists(path):
+            with open(path, "r") as timings_f:
+                self.timings = json.load(timings_f)
+
+    def record(self, identifier, stage, seconds):
+        stages = self.timings.setdefault(identifier, {})
+        if stage in stages:
+            seconds = SMOOTHING * seconds + (1 - SMOOTHING) * stages[stage]
+        stages[stage] = seconds
+
+    def seconds_per_work(self, stage, work):
+        """Average seconds per unit of work of a stage, over configurations in work with history"""
+        total_seconds = 0.0
+        total_work = 0
+        for identifier, identifier_work in work.items():
+            seconds = self.timings.get(identifier, {}).get(stage)
+            if seconds is not None:
+                total_seconds += seconds
+                total_work += identifier_work
+        return total_seconds / total_work if total_work else None
+
+    def estimates(self, stage, work):
+        """Estimated seconds of a stage for each configuration ID in work, a dict of configuration_work"""
+        seconds_per_work = self.seconds_per_work(stage, work)
+        result = {}
+        for identifier, identifier_work in work.items():
+            seconds = self.timings.get(identifier, {}).get(stage)
+            if seconds is None:
+                seconds = identifier_work * (seconds_per_work or DEFAULT_SECONDS_PER_WORK)
+            result[identifier] = seconds
+        return result
+
+    def save(self):
+        if self.path:
+            with open(self.path, "w") as timings_f:
+                json.dump(self.timings, timings_f, indent=1, sort_keys=True)
+
+
+def manifest_work(manifest, identifiers):
+    work = {}
+    for identifier in identifiers:
+        _, properties, __, repeat = manifest.configuration(identifier)
+        work[identifier] = configuration_work(properties, repeat)
+    return work
+
+
+def run_scheduled(manifest, stage, task_fn, history, identifiers=None, jobs=None):
+    """Run task_fn(identifier) for configurations of a manifest, longest first, recording how long each takes.
+
+    Starting the longest configurations first and handing out the rest to
+    whichever worker is free packs work across workers, instead of leaving one
+    worker with the slowest configurations at the end. The progress bar counts
+    estimated seconds, so its remaining time accounts for the cost of each
+    configuration. Yields (identifier, result) as configurations finish.
+    """
+    if identifiers is None:
+        identifiers = list(manifest)
+    estimates = history.estimates(stage, manifest_work(manifest, identifiers))
+    order = sorted(identifiers, key=lambda identifier: (-estimates[identifier], identifier))
+
+    def timed(identifier):
+        start = time.monotonic()
+        result = task_fn(identifier)
+        return result, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor, \
+         tqdm(total=sum(estimates.values()), desc=stage, unit="s", file=sys.stderr,
+              bar_format="{l_bar}{bar}| {n:.0f}/{total:.0f} estimated s [{elapsed}<{remaining}]") as progress:
+        futures = {executor.submit(timed, identifier): identifier for identifier in order}
+        for future in as_completed(futures):
+            identifier = futures[future]
+            result, seconds = future.result()
+            history.record(identifier, stage, seconds)
+            # Estimates summed in completion order can round past their total
+            if progress.n + estimates[identifier] > progress.total:
+                progress.total = progress.n + estimates[identifier]
+            progress.update(estimates[identifier])
+            yield identifier, result
+
+
+def build_stage(manifest, stage, history, llc="llc", jobs=None):
+    """Run a build stage on every configuration whose previous artifact exists.
+
+    The error output of a failed tool is written to <artifact>.err, as
+    `make testbeds` does, for failure_cache.py record. Returns the number of failures.
+    """
+    source = dict((name, source) for name, source, _ in BUILD_STAGES)[stage]
+    identifiers = [identifier for identifier in manifest
+                   if os.path.exists(manifest.artifact_path(identifier, source))]
+
+    def build(identifier):
+        return testbed_runner.build_stage(stage, manifest.artifact_path(identifier), llc=llc)
+
+    num_failures = 0
+    for identifier, reason in run_scheduled(manifest, stage, build, history, identifiers=identifiers, jobs=jobs):
+        if reason is not None:
+            num_failures += 1
+    return num_failures
+
+
+def run_stage(manifest, history, out=sys.stdout, jobs=None, failures=None):
+    """Run every built testbed, writing output in the format of `make run-testbeds` as each finishes
+
+    Testbeds that exit with an error or crash are not written, and are recorded in failures if given.
+    """
+    identifiers = [identifier for identifier in manifest if os.path.exists(manifest.artifact_path(identifier))]
+
+    def run(identifier):
+        return testbed_runner.run_testbed(manifest.artifact_path(identifier))
+
+    for identifier, (output, reason) in run_scheduled(manifest, "run", run, history,
+                                                      identifiers=identifiers, jobs=jobs):
+        if reason is not None:
+            # Left out of the log, so partial output is not grouped into equivalences
+            if failures is not None:
+                failures.record(identifier, manifest.configuration(identifier)[1], "run", reason)
+            continue
+        out.write("TEST START {}\n{}TEST STOP\n\n".format(manifest.configurations[identifier]["name"], output))
+    out.flush()
+
+
+def add_arguments(parser):
+    """Add timing history options to an argparse parser"""
+    parser.add_argument("--timings", type=str, default=None,
+                        help="Schedule configurations longest first using compile and run times recorded in this file, "
+                             "and record new times")
+
+
+def from_arguments(args):
+    return TimingHistory(args.timings)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Build or run the testbeds of a manifest, scheduling the slowest first")
+    parser.add_argument("stage", choices=STAGES + ["estimate"],
+                        help="Build stage or run to schedule; estimate: print the estimated time of each stage")
+    parser.add_argument("folder", type=str, nargs="?", default="tests",
+                        help="Folder containing manifest.json (may be on a tmpfs)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Concurrent processes (default: number of CPUs)")
+    add_arguments(parser)
+    failure_cache.add_arguments(parser)
+    args = parser.parse_args()
+
+    manifest = Manifest.load(args.folder)
+    history = from_arguments(args)
+
+    if args.stage == "estimate":
+        jobs = args.jobs or os.cpu_count()
+        work = manifest_work(manifest, manifest)
+        for stage in STAGES:
+            estimates = history.estimates(stage, work)
+            known = sum(1 for identifier in manifest if stage in history.timings.get(identifier, {}))
+            print("{:4} ~{:7.1f}s on {} jobs, {} of {} configurations timed, slowest {:.2f}s".format(
+                      stage, sum(estimates.values()) / jobs, jobs, known, len(manifest),
+                      max(estimates.values(), default=0.0)),
+                  file=sys.stderr)
+    elif args.stage == "run":
+        failures = failure_cache.from_arguments(args)
+        run_stage(manifest, history, jobs=args.jobs, failures=failures)
+        if failures is not None:
+            failures.save()
+    else:
+        num_failures = build_stage(manifest, args.stage, history, llc=args.llc, jobs=args.jobs)
+        if num_failures:
+            print("{}{} of {} configurations failed {}{}".format(
+                      Fore.YELLOW, num_failures, len(manifest), args.stage, Style.RESET_ALL),
+                  file=sys.stderr)
+
+    history.save()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+from colorama import Fore, Style
+import numpy as np
+
+from generate_tests import enumerate_configurations, input_element_types, test_inputs
+import conversion_db
+import convergence
+from input_corpus import InputCorpus
+import record_utils
+from testbed_manifest import Manifest, config_id
+import testbed_runner
+from utilities import Combination, get_type, tqdm_parallel_map
+
+
+LIBRARY_FILENAME = "libtestbeds.so"
+
+
+def function_symbol(identifier):
+    """Name of the exported testbed function of a configuration"""
+    return "testbed_" + identifier.replace("-", "_")
+
+
+def parameter_offsets(properties, num_repeat, combination):
+    """Return a num_repeat x num_params table of input bit offsets for each call parameter.
+
+    Bits are assigned in the same order as make_testbed in generate_tests.py:
+    VERTICAL fills the first parameter of every call first, HORIZONTAL fills
+    every parameter of the first call first.
+    """
+    param_bits = []
+    for param_type_id in properties["ParamTypes"]:
+        _, param_width, __, param_element_bits = get_type(param_type_id)
+        param_bits.append(param_width * param_element_bits)
+
+    offsets = [[0 for j in range(len(param_bits))] for i in range(num_repeat)]
+    offset = 0
+    if combination == Combination.VERTICAL:
+        for j in range(len(param_bits)):
+            for i in range(num_repeat):
+                offsets[i][j] = offset
+                offset += param_bits[j]
+    elif combination == Combination.HORIZONTAL:
+        for i in range(num_repeat):
+            for j in range(len(param_bits)):
+                offsets[i][j] = offset
+                offset += param_bits[j]
+
+    return offsets
+
+
+def call_slices(properties, num_repeat, combination):
+    """Return, for each call of a configuration, (offset, repeat-1 offset, size) in bytes of each parameter.
+
+    Copying every parameter of a call to its offset in a single call gives the
+    input on which the repeat-1 configuration makes that same call.
+    """
+    offsets = parameter_offsets(properties, num_repeat, combination)
+    single_offsets = parameter_offsets(properties, 1, Combination.HORIZONTAL)[0]
+
+    param_bits = []
+    for param_type_id in properties["ParamTypes"]:
+        _, param_width, __, param_element_bits = get_type(param_type_id)
+        param_bits.append(param_width * param_element_bits)
+
+    slices = []
+    for i in range(num_repeat):
+        call = []
+        for j, bits in enumerate(param_bits):
+            if offsets[i][j] % 8 or bits % 8:
+                raise TypeError("Parameter {} of call {} does not start on a byte boundary".format(j, i))
+            call.append((offsets[i][j] // 8, single_offsets[j] // 8, bits // 8))
+        slices.append(call)
+
+    return slices
+
+
+def output_bytes(properties, num_repeat):
+    """Number of output bytes a configuration writes per input"""
+    _, out_width, __, out_element_bits = get_type(properties["RetTypes"][0])
+    return num_repeat * out_width * out_element_bits // 8
+
+
+def make_testbed_function(identifier, intrinsic, properties, n_input_bits, num_repeat, combination):
+    """Return a LLVM IR module exporting a function that runs a configuration over a batch of inputs.
+
+    The function has the C signature
+        void testbed_<id>(const uint8_t *inputs, uint8_t *outputs, int64_t count)
+    and reads count rows of n_input_bits / 8 input bytes. Parameters are loaded
+    from the input bits in little-endian order, and the outputs of all calls are
+    stored in the same order make_testbed prints them.
+    """
+    out_dtype, out_width, _, out_element_bits = get_type(properties["RetTypes"][0])
+    out_call_bytes = out_width * out_element_bits // 8
+    if out_width * out_element_bits % 8:
+        raise TypeError("Output type {} of {} is not a whole number of bytes".format(out_dtype, intrinsic))
+
+    offsets = parameter_offsets(properties, num_repeat, combination)
+    param_types = [get_type(param_type_id)[0] for param_type_id in properties["ParamTypes"]]
+
+    body = ""
+    for i in range(num_repeat):
+        params = []
+        for j, param_type in enumerate(param_types):
+            if offsets[i][j] % 8:
+                raise TypeError("Parameter {} of {} does not start on a byte boundary".format(j, intrinsic))
+
+            body += "  %p.{i}.{j}.addr = getelementptr inbounds i8, i8* %in.row, i64 {offset}\n".format(
+                    i=i, j=j, offset=offsets[i][j] // 8)
+            body += "  %p.{i}.{j}.ptr = bitcast i8* %p.{i}.{j}.addr to {ty}*\n".format(i=i, j=j, ty=param_type)
+            body += "  %p.{i}.{j} = load {ty}, {ty}* %p.{i}.{j}.ptr, align 1\n".format(i=i, j=j, ty=param_type)
+            params.append("{} %p.{}.{}".format(param_type, i, j))
+
+        body += "  %r.{i} = call {rtype} @{intrinsic}({params})\n".format(
+                i=i, rtype=out_dtype, intrinsic=properties["LLVMFunction"], params=", ".join(params))
+        body += "  %r.{i}.addr = getelementptr inbounds i8, i8* %out.row, i64 {offset}\n".format(
+                i=i, offset=i * out_call_bytes)
+        body += "  %r.{i}.ptr = bitcast i8* %r.{i}.addr to {ty}*\n".format(i=i, ty=out_dtype)
+        body += "  store {ty} %r.{i}, {ty}* %r.{i}.ptr, align 1\n".format(i=i, ty=out_dtype)
+
+    return """; ModuleID = 'harness_{identifier}'
+target triple = "x86_64-pc-linux-gnu"
+
+; Function Attrs: nounwind
+declare {rtype} @{intrinsic}({ptypes}) #1
+
+; Function Attrs: noinline nounwind
+define void @{symbol}(i8* nocapture readonly %in, i8* nocapture %out, i64 %count) #0 {{
+entry:
+  %empty = icmp eq i64 %count, 0
+  br i1 %empty, label %exit, label %loop
+
+loop:
+  %row = phi i64 [ 0, %entry ], [ %row.next, %loop ]
+  %in.offset = mul i64 %row, {in_stride}
+  %in.row = getelementptr inbounds i8, i8* %in, i64 %in.offset
+  %out.offset = mul i64 %row, {out_stride}
+  %out.row = getelementptr inbounds i8, i8* %out, i64 %out.offset
+{body}  %row.next = add nuw i64 %row, 1
+  %done = icmp eq i64 %row.next, %count
+  br i1 %done, label %exit, label %loop
+
+exit:
+  ret void
+}}
+
+attributes #0 = {{ noinline nounwind }}
+attributes #1 = {{ nounwind readnone }}
+""".format(
+        identifier=identifier,
+        rtype=out_dtype,
+        intrinsic=properties["LLVMFunction"],
+        ptypes=", ".join(param_types),
+        symbol=function_symbol(identifier),
+        in_stride=n_input_bits // 8,
+        out_stride=num_repeat * out_call_bytes,
+        body=body)
+
+
+def compile_testbed_function(args):
+    """Lower a testbed function to a position-independent object file. Returns (identifier, success)"""
+    manifest, identifier, llc = args
+    result = subprocess.run(
+            [llc, manifest.artifact_path(identifier, ".ll"),
+             "-O0", "-mcpu=skylake-avx512", "-relocation-model=pic", "-filetype=obj",
+             "-o", manifest.artifact_path(identifier, ".o")],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return identifier, result.returncode == 0
+
+
+def build_library(folder, intrinsics, n_input_bits, llc="llc", cc="gcc", configurations=None, derive_repeats=False):
+    """Compile every configuration of the given intrinsics into one shared library.
+
+    The library does not depend on the inputs, so it is built once and reused for
+    every seed. Configurations that fail to lower are left out of the manifest.
+    If configurations, a set of configuration IDs, is given, only those are built.
+
+    With derive_repeats, only the HORIZONTAL repeat-1 configuration of each
+    intrinsic is compiled. Every other configuration is recorded as derived from
+    it, and the Harness composes its outputs from single calls on slices of the
+    inputs. Derived configurations whose repeat-1 configuration is not built are
+    left out.
+    """
+    manifest = Manifest(folder, inputs={"max_bits": n_input_bits, "llc": llc})
+    for intrinsic in sorted(intrinsics.keys()):
+        properties = intrinsics[intrinsic]
+        for num_repeat, combination in enumerate_configurations(intrinsic, properties, n_input_bits):
+            identifier = config_id(intrinsic, combination, num_repeat)
+            if configurations is not None and identifier not in configurations:
+                continue
+
+            try:
+                if derive_repeats and (num_repeat, combination) != (1, Combination.HORIZONTAL):
+                    call_slices(properties, num_repeat, combination)
+                    manifest.add_derived(intrinsic, properties, combination, num_repeat,
+                                         config_id(intrinsic, Combination.HORIZONTAL, 1))
+                else:
+                    testbed = make_testbed_function(identifier, intrinsic, properties,
+                                                    n_input_bits, num_repeat, combination)
+                    manifest.add_testbed(intrinsic, properties, combination, num_repeat, testbed)
+            except TypeError as e:
+                print(e)
+
+    compiled = [identifier for identifier in manifest if "derived_from" not in manifest.configurations[identifier]]
+    with ThreadPoolExecutor() as executor:
+        jobs = [(manifest, identifier, llc) for identifier in compiled]
+        results = list(tqdm_parallel_map(executor, compile_testbed_function, jobs, desc="llc"))
+
+    for identifier, success in results:
+        if not success:
+            print("{}Failed to lower {}{}".format(Fore.YELLOW, identifier, Style.RESET_ALL), file=sys.stderr)
+            del manifest.configurations[identifier]
+            compiled.remove(identifier)
+
+    for identifier in list(manifest):
+        source = manifest.configurations[identifier].get("derived_from")
+        if source is not None and source not in manifest.configurations:
+            del manifest.configurations[identifier]
+
+    objects = [manifest.artifact_path(identifier, ".o") for identifier in compiled]
+    subprocess.run([cc, "-shared", "-o", os.path.join(folder, LIBRARY_FILENAME)] + objects, check=True)
+
+    manifest.save()
+    return manifest
+
+
+class Harness(object):
+    """Runs configurations compiled by build_library in-process, on batches of inputs.
+
+    A configuration that crashes takes the harness down with it, so crashing
+    configurations should be removed from the manifest before a campaign.
+    Configurations derived from a repeat-1 configuration (see build_library) have
+    no function of their own.
+    """
+
+    def __init__(self, folder):
+        self.manifest = Manifest.load(folder)
+        self.input_bytes = self.manifest.inputs["max_bits"] // 8
+        self.library = ctypes.CDLL(os.path.abspath(os.path.join(folder, LIBRARY_FILENAME)))
+
+        self.functions = {}
+        self.output_bytes = {}
+        self.derived = {}
+        for identifier in self.manifest:
+            _, properties, combination, num_repeat = self.manifest.configuration(identifier)
+            self.output_bytes[identifier] = output_bytes(properties, num_repeat)
+            source = self.manifest.configurations[identifier].get("derived_from")
+            if source is not None:
+                self.derived[identifier] = (source, call_slices(properties, num_repeat, combination))
+                continue
+
+            function = self.library[function_symbol(identifier)]
+            function.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int64]
+            function.restype = None
+            self.functions[identifier] = function
+
+    def run(self, identifier, inputs, cache=None):
+        """Run a configuration on each row of inputs, a (count, input_bytes) uint8 array
+
+        cache is a dict of single call outputs of derived configurations, only valid for these inputs.
+        """
+        inputs = np.ascontiguousarray(inputs, dtype=np.uint8)
+        assert inputs.ndim == 2 and inputs.shape[1] == self.input_bytes
+
+        if identifier in self.derived:
+            return self.run_derived(identifier, inputs, cache)
+
+        outputs = np.empty((inputs.shape[0], self.output_bytes[identifier]), dtype=np.uint8)
+        self.functions[identifier](inputs.ctypes.data, outputs.ctypes.data, inputs.shape[0])
+        return outputs
+
+    def run_derived(self, identifier, inputs, cache=None):
+        """Compose the outputs of a derived configuration from its repeat-1 configuration.
+
+        Each call runs the repeat-1 configuration on the input bits of that call,
+        packed as make_testbed packs HORIZONTAL and VERTICAL calls. Calls on the
+        same slices, such as the first calls of every HORIZONTAL repeat, run once
+        per cache.
+        """
+        source, slices = self.derived[identifier]
+        call_bytes = self.output_bytes[source]
+
+        outputs = np.empty((inputs.shape[0], self.output_bytes[identifier]), dtype=np.uint8)
+        for i, call in enumerate(slices):
+            key = (source, tuple(call))
+            call_outputs = cache.get(key) if cache is not None else None
+            if call_outputs is None:
+                call_inputs = np.zeros_like(inputs)
+                for offset, single_offset, num_bytes in call:
+                    call_inputs[:, single_offset:single_offset + num_bytes] = inputs[:, offset:offset + num_bytes]
+                call_outputs = self.run(source, call_inputs)
+                if cache is not None:
+                    cache[key] = call_outputs
+            outputs[:, i * call_bytes:(i + 1) * call_bytes] = call_outputs
+
+        return outputs
+
+    def find_common_outputs(self, inputs):
+        """For each row of inputs, return lists of testbed names that produced identical outputs.
+
+        This is the in-process counterpart of find_common_outputs in
+        find_identical_intrinsics.py, keyed by output digests instead of log text.
+        """
+        digests = [defaultdict(list) for row in range(inputs.shape[0])]
+
+        cache = {}
+        for identifier in self.manifest:
+            name = self.manifest.configurations[identifier]["name"]
+            outputs = self.run(identifier, inputs, cache=cache)
+            for row in range(outputs.shape[0]):
+                digest = hashlib.blake2b(outputs[row].tobytes(), digest_size=16).digest()
+                digests[row][digest].append(name)
+
+        return [list(output_to_intrinsics.values()) for output_to_intrinsics in digests]
+
+
+def make_inputs(n_input_bits, tests, element_types=None):
+    """Return a (count, n_input_bits / 8) uint8 array with one row of input bits per test.
+
+    Args:
+        tests: list of (kind, value) tuples, where kind is "seed", "corner" or "index".
+        element_types: input_element_types of the tested intrinsics, for "corner" tests.
+    """
+    num_input_bytes = n_input_bits // 8
+    rows = []
+    for kind, value in tests:
+        inputs = test_inputs(n_input_bits, kind, value, element_types=element_types)
+        rows.append(inputs.to_bytes(num_input_bytes, "little"))
+
+    return np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), num_input_bytes)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Build and run testbeds in-process from a shared library")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser("build", help="Compile all configurations into a shared library")
+    build_parser.add_argument("folder", type=str,
+                              help="Folder in which to store the library and its manifest")
+    build_parser.add_argument("--max-bits", type=int, default=2048,
+                              help="Maximum number of bits per input")
+    build_parser.add_argument("--llc", type=str, default="llc",
+                              help="Path to llc")
+    build_parser.add_argument("--derive-repeats", action="store_true",
+                              help="Only compile repeat-1 configurations, and compose the outputs of other "
+                                   "repeats and combinations from single calls")
+
+    run_parser = subparsers.add_parser("run", help="Run the library on inputs and find equivalent configurations")
+    run_parser.add_argument("folder", type=str,
+                            help="Folder containing the library built by the build command")
+    testbed_runner.add_test_arguments(run_parser)
+    run_parser.add_argument("--corpus", type=str, default=None,
+                            help="Run every input of a corpus built by input_corpus.py instead of the ranges above")
+    run_parser.add_argument("--batch-size", type=int, default=256,
+                            help="Number of inputs passed to each testbed function call")
+    run_parser.add_argument("--output-folder", type=str, required=True,
+                            help="Folder in which to log equivalences")
+    convergence.add_arguments(run_parser)
+    conversion_db.add_arguments(run_parser)
+    args = parser.parse_args()
+
+    with open("intrinsics_all.json") as intrinsics_file:
+        intel_vector = record_utils.filter_intel_vector(json.load(intrinsics_file))
+
+    if args.command == "build":
+        build_library(args.folder, intel_vector, args.max_bits, llc=args.llc, derive_repeats=args.derive_repeats)
+    elif args.command == "run":
+        import coloredlogs
+        from find_identical_intrinsics import refine_equivalences, report_equivalences
+
+        coloredlogs.install()
+
+        harness = Harness(args.folder)
+        if args.corpus:
+            corpus = InputCorpus(args.corpus)
+            assert corpus.max_bits == harness.manifest.inputs["max_bits"]
+            tests = corpus.tests()
+        else:
+            tests = testbed_runner.tests_from_arguments(args)
+
+        element_types = input_element_types(intel_vector)
+        equivalences = {}
+        monitor = convergence.from_arguments(args)
+        for start in range(0, len(tests), args.batch_size):
+            if args.corpus:
+                # Memory-mapped rows are passed to the testbeds without copying
+                inputs = corpus.rows[start:start + args.batch_size]
+            else:
+                inputs = make_inputs(harness.manifest.inputs["max_bits"],
+                                     tests[start:start + args.batch_size],
+                                     element_types=element_types)
+
+            for candidate_equivalences in harness.find_common_outputs(inputs):
+                refine_equivalences(equivalences, candidate_equivalences)
+
+            monitor.update(equivalences, inputs.shape[0])
+            print(monitor.summary(), file=sys.stderr)
+            if monitor.converged():
+                print("Converged, skipping {} remaining tests".format(len(tests) - monitor.num_tests), file=sys.stderr)
+                break
+
+        results = report_equivalences(equivalences, monitor.num_tests, args.output_folder)
+        conversion_db.record_from_arguments(args, results, monitor.num_tests, llc=harness.manifest.inputs.get("llc"),
+                                            provenance={"tests": testbed_runner.test_ranges(tests[:monitor.num_tests])
+                                                                 if not args.corpus else None,
+                                                        "corpus": args.corpus})
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+import argparse
+from collections import defaultdict
+import hashlib
+import json
+import os
+import re
+import sys
+
+from colorama import Fore, Style
+
+from testbed_manifest import Manifest
+
+
+# Instructions that only move data. A call region made of nothing else means
+# llc constant folded the intrinsic, so its outputs come from LLVM rather than
+# the hardware.
+DATA_MOVEMENT = {
+    "movb", "movw", "movl", "movq", "movabsq", "movzbl", "leaq",
+    "movd", "vmovd", "vmovq", "vmovss", "vmovsd",
+    "movaps", "movups", "movapd", "movupd", "movdqa", "movdqu",
+    "vmovaps", "vmovups", "vmovapd", "vmovupd", "vmovdqa", "vmovdqu",
+    "vmovdqa32", "vmovdqa64", "vmovdqu8", "vmovdqu16", "vmovdqu32", "vmovdqu64",
+    "kmovb", "kmovw", "kmovd", "kmovq",
+}
+
+# Instructions that produce zero when every operand is the same register
+ZEROING_IDIOMS = {
+    "xorl", "pxor", "vpxor", "vpxord", "vpxorq", "xorps", "vxorps", "xorpd", "vxorpd",
+}
+
+# Registers that only set up the stack frame
+FRAME_REGISTERS = {"%rsp", "%rbp"}
+
+# Function of the testbeds computing the outputs, and the function they pass them to
+TESTBED_FUNCTION = "main"
+OUTPUT_FUNCTION = "print_bytes"
+
+# Registers of the first two integer arguments in the System V ABI, in which
+# the outputs and their size are passed to print_bytes
+ARGUMENT_REGISTER_RE = re.compile(r"^%(rdi|edi|di|dil|rsi|esi|si|sil)$")
+
+VECTOR_REGISTER_RE = re.compile(r"%([xyz]mm)(\d+)\b")
+MASK_REGISTER_RE = re.compile(r"%k(\d)\b")
+GPR_RE = re.compile(r"%(r|e)?([abcd])([xlh])\b|%(r|e)?(si|di)(l)?\b|%r(\d+)([dwb])?\b")
+CONSTANT_POOL_RE = re.compile(r"\.LCPI\d+_\d+(\(%rip\))?")
+STACK_SLOT_RE = re.compile(r"-?(?:0x)?[0-9a-f]*\((%rsp|%rbp)\)")
+IMMEDIATE_RE = re.compile(r"\$-?(?:0x)?[0-9a-fA-F]+")
+
+
+def call_target(mnemonic, operands):
+    """Symbol called by an instruction (call or callq, direct or through the PLT), or None"""
+    if not mnemonic.startswith("call"):
+        return None
+    return operands.strip().partition("@")[0]
+
+
+def call_region(assembly):
+    """Return the instructions of main that compute the outputs, as (mnemonic, operands) tuples.
+
+    The region starts at the main symbol and stops at the first call to the
+    print_bytes symbol, so calls the intrinsic is lowered into are kept.
+    Directives, labels, comments, stack frame setup and the print_bytes
+    arguments set up before that call are dropped.
+    """
+    instructions = []
+    in_function = False
+    for line in assembly.splitlines():
+        line = line.split("#")[0].strip()
+        if line == TESTBED_FUNCTION + ":":
+            in_function = True
+            continue
+        if not in_function or not line or line.startswith(".") or line.endswith(":"):
+            continue
+
+        mnemonic, _, operands = line.partition("\t")
+        if call_target(mnemonic, operands) == OUTPUT_FUNCTION:
+            break
+        if mnemonic in ("pushq", "popq", "vzeroupper"):
+            continue
+
+        operand_list = [operand.strip() for operand in operands.split(",")] if operands else []
+        if operand_list and operand_list[-1] in FRAME_REGISTERS:
+            continue
+
+        instructions.append((mnemonic, operand_list))
+
+    # Arguments of print_bytes are written right before the call
+    while instructions and instructions[-1][1] and ARGUMENT_REGISTER_RE.match(instructions[-1][1][-1]):
+        instructions.pop()
+
+    return [(mnemonic, ", ".join(operand_list)) for mnemonic, operand_list in instructions]
+
+
+def canonicalize(instructions):
+    """Rename registers and stack slots in order of first use, and hide constants.
+
+    Two configurations lowering to the same instruction sequence on different
+    inputs then have the same canonical code.
+    """
+    names = {}
+
+    def rename(kind, key, prefix):
+        key = (kind, key)
+        if key not in names:
+            names[key] = sum(1 for other in names if other[0] == kind)
+        return "{}{}".format(prefix, names[key])
+
+    def gpr(match):
+        if match.group(2):
+            family = match.group(2)
+            width = {"r": 64, "e": 32, None: 16}[match.group(1)] if match.group(3) == "x" else 8
+        elif match.group(5):
+            family = match.group(5)
+            width = 8 if match.group(6) else {"r": 64, "e": 32, None: 16}[match.group(4)]
+        else:
+            family = "r" + match.group(7)
+            width = {None: 64, "d": 32, "w": 16, "b": 8}[match.group(8)]
+        return "%{}.{}".format(rename("gpr", family, "gpr"), width)
+
+    lines = []
+    for mnemonic, operands in instructions:
+        operands = CONSTANT_POOL_RE.sub("CONSTANT", operands)
+        operands = STACK_SLOT_RE.sub(lambda match: rename("stack", match.group(0), "STACK"), operands)
+        operands = IMMEDIATE_RE.sub("$IMM", operands)
+        operands = VECTOR_REGISTER_RE.sub(
+            lambda match: "%" + match.group(1) + rename("vector", match.group(2), "."), operands)
+        operands = MASK_REGISTER_RE.sub(lambda match: "%" + rename("mask", match.group(1), "k"), operands)
+        operands = GPR_RE.sub(gpr, operands)
+        lines.append("{}\t{}".format(mnemonic, operands))
+
+    return lines
+
+
+def structural_hash(canonical_lines):
+    return hashlib.blake2b("\n".join(canonical_lines).encode(), digest_size=16).hexdigest()
+
+
+def is_constant_folded(instructions):
+    for mnemonic, operands in instructions:
+        if mnemonic in DATA_MOVEMENT:
+            continue
+        if mnemonic in ZEROING_IDIOMS and len(set(operand.strip() for operand in operands.split(","))) == 1:
+            continue
+        return False
+    return True
+
+
+def instruction_signature(instructions):
+    """Distinct instructions of a call region that compute, with operands reduced to their kind.
+
+    Registers lose their number and width, and repeated instructions count once,
+    so k calls of a 128-bit intrinsic have the signature of one call of a wider
+    intrinsic lowering to the same instructions. Data movement is left out, as
+    its mnemonic depends on the width alone (vmovdqa, vmovdqa64).
+    """
+    lines = set()
+    for mnemonic, operands in instructions:
+        if mnemonic in DATA_MOVEMENT:
+            continue
+        operands = CONSTANT_POOL_RE.sub("CONSTANT", operands)
+        operands = STACK_SLOT_RE.sub("STACK", operands)
+        operands = IMMEDIATE_RE.sub("$IMM", operands)
+        operands = VECTOR_REGISTER_RE.sub("%vector", operands)
+        operands = MASK_REGISTER_RE.sub("%mask", operands)
+        operands = GPR_RE.sub("%gpr", operands)
+        lines.add("{}\t{}".format(mnemonic, operands))
+    return tuple(sorted(lines))
+
+
+def screen_manifest(manifest):
+    """Hash the lowered call region of every configuration that llc compiled.
+
+    Returns (structural_groups, folded, pruned): lists of configuration IDs with
+    identical canonical code, IDs of constant folded configurations, and IDs that
+    failed to lower or share their instruction signature with no configuration
+    of another intrinsic, as conversions only replace an intrinsic by another.
+
+    Which configurations llc folds depends on their inputs, and the outputs of a
+    folded configuration could match any other. So no configuration of an
+    intrinsic with a folded configuration is pruned, nor any configuration
+    sharing its signature with a folded one.
+    """
+    hash_to_identifiers = defaultdict(list)
+    signatures = {}
+    signature_to_intrinsics = defaultdict(set)
+    folded_signatures = set()
+    folded_intrinsics = set()
+    folded = []
+    pruned = []
+    for identifier in manifest:
+        assembly_path = manifest.artifact_path(identifier, ".s")
+        if not os.path.exists(assembly_path):
+            pruned.append(identifier)
+            continue
+
+        with open(assembly_path, "r") as assembly_file:
+            instructions = call_region(assembly_file.read())
+
+        intrinsic = manifest.configurations[identifier]["intrinsic"]
+        if is_constant_folded(instructions):
+            folded.append(identifier)
+            folded_signatures.add(instruction_signature(instructions))
+            folded_intrinsics.add(intrinsic)
+            continue
+
+        hash_to_identifiers[structural_hash(canonicalize(instructions))].append(identifier)
+        signatures[identifier] = instruction_signature(instructions)
+        signature_to_intrinsics[signatures[identifier]].add(intrinsic)
+
+    for identifier, signature in signatures.items():
+        intrinsic = manifest.configurations[identifier]["intrinsic"]
+        if (intrinsic not in folded_intrinsics and signature not in folded_signatures
+                and signature_to_intrinsics[signature] == {intrinsic}):
+            pruned.append(identifier)
+
+    structural_groups = sorted(identifiers for identifiers in hash_to_identifiers.values() if len(identifiers) > 1)
+    return structural_groups, folded, sorted(pruned)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Compare testbeds lowered by llc before assembling, linking or running them")
+    parser.add_argument("folder", type=str, nargs="?", default="tests",
+                        help="Folder containing manifest.json and testbeds lowered to .s")
+    parser.add_argument("--prune", type=str, default=None, metavar="PRUNED_JSON",
+                        help="Remove configurations that can never be equivalent from the manifest, so they are not "
+                             "built or run. They are found in the first folder screened and saved to this file, "
+                             "and the same configurations are removed from later folders, whatever their inputs")
+    parser.add_argument("--output-folder", type=str, default=None,
+                        help="Folder in which to write static_equivalences.json, listing structurally equivalent candidates")
+    args = parser.parse_args()
+
+    manifest = Manifest.load(args.folder)
+    structural_groups, folded, pruned = screen_manifest(manifest)
+
+    print("{} configurations: {} structurally equivalent groups, {} constant folded, {} pruned".format(
+              len(manifest), len(structural_groups), len(folded), len(pruned)),
+          file=sys.stderr)
+
+    if args.output_folder:
+        os.makedirs(args.output_folder, exist_ok=True)
+        with open(os.path.join(args.output_folder, "static_equivalences.json"), "w") as equiv_f:
+            json.dump({
+                "structural": [[manifest.configurations[identifier]["name"] for identifier in group]
+                               for group in structural_groups],
+                "constant_folded": [manifest.configurations[identifier]["name"] for identifier in folded],
+                "pruned": [manifest.configurations[identifier]["name"] for identifier in pruned],
+            }, equiv_f, indent=1)
+
+    if args.prune:
+        # Pruning the same configurations for every input keeps them refined by every test
+        if os.path.exists(args.prune):
+            with open(args.prune, "r") as pruned_f:
+                pruned = json.load(pruned_f)
+        else:
+            with open(args.prune, "w") as pruned_f:
+                json.dump(pruned, pruned_f, indent=1)
+
+        pruned = [identifier for identifier in pruned if identifier in manifest.configurations]
+        for identifier in pruned:
+            del manifest.configurations[identifier]
+        manifest.save()
+        print("{}Pruned {} configurations{}".format(Fore.YELLOW, len(pruned), Style.RESET_ALL), file=sys.stderr)
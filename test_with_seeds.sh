@@ -2,14 +2,22 @@
 
 set -ex
 
+# Testbeds may be generated on a tmpfs, e.g. TESTS=/dev/shm/intransitive
+TESTS=${TESTS:-tests}
+# Inputs may be read from a corpus built by input_corpus.py, e.g. CORPUS=corpus
+CORPUS_ARGS=${CORPUS:+--corpus $CORPUS}
+# Configurations that failed to build or run for earlier inputs may be skipped, e.g. FAILURES=logs/failures.json
+LLC=${LLC:-/mnt/revec/build-master-rel-alltarget/bin/llc}
+FAILURE_ARGS=${FAILURES:+--failures $FAILURES --llc $LLC}
+
 for seed in $(seq $1 $2); do
     # NOTE: Cannot run these in parallel, as they overwrite the
     # tests directory.
-    rm -rf tests
-    python3 generate_tests.py --seed $seed
-    make testbeds LLC=/mnt/revec/build-master-rel-alltarget/bin/llc
+    rm -rf $TESTS
+    python3 generate_tests.py --seed $seed --output-folder $TESTS $CORPUS_ARGS $FAILURE_ARGS
+    make testbeds LLC=$LLC TESTS=$TESTS FAILURES=$FAILURES
 
     mkdir -p logs
-    make run-testbeds > logs/testbeds_seed$seed.log
+    make run-testbeds LLC=$LLC TESTS=$TESTS FAILURES=$FAILURES > logs/testbeds_seed$seed.log
 done
 
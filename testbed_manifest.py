@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+from utilities import Combination
+
+
+MANIFEST_FILENAME = "manifest.json"
+TESTBED_FOLDER = "testbeds"
+
+# Stages that build a testbed executable, with the artifact suffix each reads and writes
+BUILD_STAGES = (("llc", ".ll", ".s"), ("as", ".s", ".o"), ("link", ".o", ""))
+
+
+def config_id(intrinsic, combination, repeat):
+    """Flat, filename-safe identifier of an intrinsic configuration"""
+    return "{}-{}-{}".format(intrinsic, combination.name, repeat)
+
+
+def testbed_name(intrinsic, combination, repeat):
+    """Name of a configuration as reported in test logs.
+
+    This is the path the testbed had in the original tests/ directory tree,
+    which find_identical_intrinsics.py parses to recover the configuration.
+    """
+    return "tests/{}/combo_{}/repeat_{}/testbed".format(intrinsic, combination.name, repeat)
+
+
+class Manifest(object):
+    """Index of the testbeds generated for a single input.
+
+    Instead of one directory (and one copy of properties.json) per configuration,
+    testbeds are packed into a single artifact folder and described by one manifest
+    mapping each configuration ID to its intrinsic, combination, repeat and the
+    intrinsic whose properties it uses.
+    """
+
+    def __init__(self, folder, inputs=None):
+        self.folder = folder
+        self.inputs = inputs or {}
+        self.properties = {}
+        self.configurations = {}
+
+    @classmethod
+    def load(cls, folder):
+        with open(os.path.join(folder, MANIFEST_FILENAME), "r") as manifest_f:
+            data = json.load(manifest_f)
+
+        manifest = cls(folder, inputs=data["inputs"])
+        manifest.properties = data["properties"]
+        manifest.configurations = data["configurations"]
+        return manifest
+
+    def save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, MANIFEST_FILENAME), "w") as manifest_f:
+            json.dump({
+                "inputs": self.inputs,
+                "properties": self.properties,
+                "configurations": self.configurations,
+            }, manifest_f)
+
+    def add_testbed(self, intrinsic, properties, combination, repeat, testbed):
+        """Store the LLVM IR source of a testbed and record it in the manifest"""
+        identifier = config_id(intrinsic, combination, repeat)
+
+        self.properties[intrinsic] = properties
+        self.configurations[identifier] = {
+            "intrinsic": intrinsic,
+            "combination": combination.name,
+            "repeat": repeat,
+            "name": testbed_name(intrinsic, combination, repeat),
+        }
+
+        testbed_folder = os.path.join(self.folder, TESTBED_FOLDER)
+        os.makedirs(testbed_folder, exist_ok=True)
+        with open(self.artifact_path(identifier, ".ll"), "w") as testbed_file:
+            testbed_file.write(testbed)
+
+        return identifier
+
+    def add_derived(self, intrinsic, properties, combination, repeat, source):
+        """Record a configuration without a testbed, whose outputs are composed from those of the source configuration"""
+        identifier = config_id(intrinsic, combination, repeat)
+
+        self.properties[intrinsic] = properties
+        self.configurations[identifier] = {
+            "intrinsic": intrinsic,
+            "combination": combination.name,
+            "repeat": repeat,
+            "name": testbed_name(intrinsic, combination, repeat),
+            "derived_from": source,
+        }
+
+        return identifier
+
+    def artifact_path(self, identifier, suffix=""):
+        """Path of a build artifact (.ll, .s, .o or the executable) of a configuration"""
+        return os.path.join(self.folder, TESTBED_FOLDER, identifier + suffix)
+
+    def configuration(self, identifier):
+        """Return (intrinsic, properties, combination, repeat) of a configuration"""
+        entry = self.configurations[identifier]
+        return (entry["intrinsic"],
+                self.properties[entry["intrinsic"]],
+                Combination[entry["combination"]],
+                entry["repeat"])
+
+    def __iter__(self):
+        return iter(sorted(self.configurations))
+
+    def __len__(self):
+        return len(self.configurations)
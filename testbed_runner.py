@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Building and running testbeds, and the tests to run them on.
+
+The scripts that drive testbeds (intransitive.py, pipeline.py, scheduler.py)
+build and run them with these functions, and those that take ranges of tests
+on their command line (pipeline.py, shared_harness.py, verify_conversions.py,
+pair_tests.py) read them with add_test_arguments and tests_from_arguments.
+"""
+
+import os
+import subprocess
+
+import failure_cache
+from testbed_manifest import BUILD_STAGES
+
+
+def build_command(stage, path, llc="llc"):
+    """Command of a build stage for the testbed whose artifacts are at path + suffix, as `make testbeds`"""
+    if stage == "llc":
+        return [llc, path + ".ll", "-O0", "-mcpu=skylake-avx512", "-o", path + ".s"]
+    elif stage == "as":
+        return ["as", path + ".s", "--64", "-o", path + ".o"]
+    elif stage == "link":
+        return ["gcc", "-m64", path + ".o", "-o", path]
+
+    raise ValueError("Unknown build stage {}".format(stage))
+
+
+def build_stage(stage, path, llc="llc"):
+    """Run one build stage of the testbed whose artifacts are at path + suffix.
+
+    Returns None if it succeeded, or a summary of why it failed. The error
+    output of a failed tool is written to <artifact>.err, as `make testbeds`
+    does, for failure_cache.py record.
+    """
+    source = dict((name, source) for name, source, _ in BUILD_STAGES)[stage]
+    process = subprocess.run(build_command(stage, path, llc=llc), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode == 0:
+        return None
+
+    with open(path + source + ".err", "wb") as error_f:
+        error_f.write(process.stderr)
+    return failure_cache.error_summary(process.stderr.decode(errors="replace"),
+                                       "{} {}".format(stage, failure_cache.exit_reason(process.returncode)))
+
+
+def build_testbed(path, llc="llc"):
+    """Lower, assemble and link a testbed. Returns None if the executable was built, or (stage, reason) of the failure"""
+    for stage, _, __ in BUILD_STAGES:
+        reason = build_stage(stage, path, llc=llc)
+        if reason is not None:
+            return stage, reason
+    return None
+
+
+def run_testbed(path):
+    """Run a built testbed. Returns (output, reason), reason being None unless it exited with an error or crashed"""
+    process = subprocess.run([os.path.abspath(path)], stdout=subprocess.PIPE)
+    reason = failure_cache.exit_reason(process.returncode) if process.returncode != 0 else None
+    return process.stdout.decode(errors="replace"), reason
+
+
+def test_list(seeds=None, corner_case_seeds=None, test_indices=None):
+    """List (kind, value) of the tests in inclusive (first, last) ranges of each kind"""
+    tests = []
+    for kind, test_range in zip(("seed", "corner", "index"), (seeds, corner_case_seeds, test_indices)):
+        if test_range:
+            tests.extend((kind, value) for value in range(test_range[0], test_range[1] + 1))
+    return tests
+
+
+def test_ranges(tests):
+    """Summarize (kind, value) tests as runs of consecutive values, {"kind", "first", "count"}, e.g. for provenance"""
+    ranges = []
+    for kind, value in tests:
+        if ranges and ranges[-1]["kind"] == kind and ranges[-1]["first"] + ranges[-1]["count"] == value:
+            ranges[-1]["count"] += 1
+        else:
+            ranges.append({"kind": kind, "first": value, "count": 1})
+    return ranges
+
+
+def add_test_arguments(parser, seeds_help="Inclusive range of random input seeds"):
+    """Add options selecting ranges of tests to an argparse parser"""
+    parser.add_argument("--seeds", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help=seeds_help)
+    parser.add_argument("--corner-case-seeds", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="Inclusive range of seeds for type-aware corner case inputs")
+    parser.add_argument("--test-indices", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="Inclusive range of edge case test indices")
+
+
+def tests_from_arguments(args):
+    return test_list(args.seeds, args.corner_case_seeds, args.test_indices)
@@ -2,6 +2,7 @@
 
 import concurrent.futures
 import enum
+import functools
 import re
 
 from colorama import Fore, Style
@@ -22,6 +23,7 @@ class Combination(enum.Enum):
     ANY = 3
 
 
+@functools.lru_cache(maxsize=None)
 def get_type(identifier):
     m = re.match(r"llvm_v([0-9]+)([if])([0-9]+)_ty", identifier)
     if m:
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+
+from colorama import Fore, Style
+import numpy as np
+
+from generate_tests import input_element_types
+from input_corpus import InputCorpus
+import record_utils
+from shared_harness import Harness, build_library, make_inputs
+from testbed_manifest import config_id
+import testbed_runner
+from utilities import Combination
+
+
+def concrete_configurations(configuration):
+    """Configuration IDs a conversion configuration stands for.
+
+    ANY means both combinations were found equivalent, so both are checked,
+    except for a single call where HORIZONTAL and VERTICAL are the same testbed.
+    """
+    combination = configuration["combination"]
+    if combination == "ANY":
+        combinations = ["VERTICAL"] if configuration["repeat"] == 1 else ["HORIZONTAL", "VERTICAL"]
+    else:
+        combinations = [combination]
+
+    return [config_id(configuration["id"], Combination[name], configuration["repeat"]) for name in combinations]
+
+
+def verify_conversions(harness, conversions, tests, inputs_fn, batch_size=256):
+    """Run the base and target of each conversion on tests, and check their outputs are identical.
+
+    Returns a list with one (status, reason) per conversion, where status is
+    "confirmed", "broken" or "missing" (a configuration was not built).
+
+    Args:
+        conversions: list of [base, target] configuration dicts, as in test_conversions.json.
+        tests: list of (kind, value) tests.
+        inputs_fn: function mapping a slice of tests to a (count, input_bytes) uint8 array.
+    """
+    results = [("confirmed", None) for conversion in conversions]
+    for index, (base, target) in enumerate(conversions):
+        for identifier in concrete_configurations(base) + concrete_configurations(target):
+            if identifier not in harness.manifest.configurations:
+                results[index] = ("missing", "{} was not built".format(identifier))
+
+    for start in range(0, len(tests), batch_size):
+        inputs = inputs_fn(tests[start:start + batch_size])
+        outputs = {}
+
+        def run(identifier):
+            if identifier not in outputs:
+                outputs[identifier] = harness.run(identifier, inputs)
+            return outputs[identifier]
+
+        for index, (base, target) in enumerate(conversions):
+            if results[index][0] != "confirmed":
+                continue
+
+            target_identifier = concrete_configurations(target)[0]
+            for base_identifier in concrete_configurations(base):
+                base_outputs = run(base_identifier)
+                target_outputs = run(target_identifier)
+                if base_outputs.shape != target_outputs.shape:
+                    results[index] = ("broken", "{} writes {} bytes, {} writes {}".format(
+                            base_identifier, base_outputs.shape[1], target_identifier, target_outputs.shape[1]))
+                    break
+
+                mismatches = np.flatnonzero((base_outputs != target_outputs).any(axis=1))
+                if mismatches.size:
+                    kind, value = tests[start + mismatches[0]]
+                    results[index] = ("broken", "{} and {} differ on {} {}".format(
+                            base_identifier, target_identifier, kind, value))
+                    break
+
+    return results
+
+
+def add_input_arguments(parser):
+    """Add options selecting the inputs to verify conversions on to an argparse parser"""
+    parser.add_argument("--max-bits", type=int, default=2048,
+                        help="Number of bits per input, as used by the campaign that found the conversions")
+    testbed_runner.add_test_arguments(
+            parser, seeds_help="Inclusive range of random input seeds, preferably not used by the campaign")
+    parser.add_argument("--corpus", type=str, default=None,
+                        help="Run every input of a corpus built by input_corpus.py instead of the ranges above")
+
+
+def inputs_from_arguments(args, intel_vector):
+    """Return (tests, inputs_fn) for the inputs selected on the command line, exiting if there are none"""
+    if args.corpus:
+        corpus = InputCorpus(args.corpus)
+        assert corpus.max_bits == args.max_bits
+        tests = corpus.tests()
+        inputs_fn = lambda batch: corpus.rows[corpus.row(*batch[0]):corpus.row(*batch[0]) + len(batch)]
+    else:
+        tests = testbed_runner.tests_from_arguments(args)
+        element_types = input_element_types(intel_vector)
+        inputs_fn = lambda batch: make_inputs(args.max_bits, batch, element_types=element_types)
+
+    if not tests:
+        print("{}No inputs given, use --seeds, --corner-case-seeds, --test-indices or --corpus{}".format(
+                  Fore.RED, Style.RESET_ALL),
+              file=sys.stderr)
+        sys.exit(1)
+
+    return tests, inputs_fn
+
+
+def conversion_intrinsics(conversions, intel_vector):
+    """Records of the base and target intrinsics of conversions"""
+    return {intrinsic: intel_vector[intrinsic]
+            for intrinsic in set(base["id"] for base, _ in conversions) | set(target["id"] for _, target in conversions)
+            if intrinsic in intel_vector}
+
+
+def write_results(conversions, results, output_folder):
+    """Print conversions that did not hold, and write verified_conversions.json and broken_conversions.json.
+
+    Returns the confirmed conversions.
+    """
+    confirmed = []
+    broken = []
+    for conversion, (status, reason) in zip(conversions, results):
+        if status == "confirmed":
+            confirmed.append(conversion)
+        else:
+            broken.append({"base": conversion[0], "target": conversion[1], "status": status, "reason": reason})
+            print("{}{:9} {} x{} => {}: {}{}".format(Fore.RED, status, conversion[0]["id"], conversion[0]["repeat"],
+                                                      conversion[1]["id"], reason, Style.RESET_ALL),
+                  file=sys.stderr)
+
+    os.makedirs(output_folder, exist_ok=True)
+    with open(os.path.join(output_folder, "verified_conversions.json"), "w") as verified_f:
+        json.dump(confirmed, verified_f)
+    with open(os.path.join(output_folder, "broken_conversions.json"), "w") as broken_f:
+        json.dump(broken, broken_f, indent=1)
+
+    return confirmed
+
+
+def write_header(conversions, header, format="map"):
+    """Regenerate IntrinsicConversion.h from conversions"""
+    from generate_intrinsic_map import make_map_source, make_table_source
+
+    header_source = make_table_source(conversions) if format == "table" else make_map_source(conversions)
+    with open(header, "w") as header_f:
+        header_f.write(header_source)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Check that known conversions still hold, e.g. with a new llc or CPU")
+    parser.add_argument("--conversions", type=str, default="logs/test_conversions.json",
+                        help="Conversions to verify, as written by find_identical_intrinsics.py")
+    parser.add_argument("--folder", type=str, default="verify",
+                        help="Folder in which to build the shared library of base and target configurations")
+    parser.add_argument("--llc", type=str, default="llc",
+                        help="Path to llc")
+    add_input_arguments(parser)
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="Number of inputs passed to each testbed function call")
+    parser.add_argument("--output-folder", type=str, default="logs",
+                        help="Folder in which to write verified_conversions.json and broken_conversions.json")
+    parser.add_argument("--header", type=str, default=None,
+                        help="Regenerate IntrinsicConversion.h at this path from the confirmed conversions only")
+    parser.add_argument("--format", choices=["map", "table"], default="map",
+                        help="Header format, as for generate_intrinsic_map.py")
+    args = parser.parse_args()
+
+    with open(args.conversions, "r") as conversions_f:
+        conversions = json.load(conversions_f)
+
+    with open("intrinsics_all.json") as intrinsics_file:
+        intel_vector = record_utils.filter_intel_vector(json.load(intrinsics_file))
+
+    tests, inputs_fn = inputs_from_arguments(args, intel_vector)
+
+    # Only the base and target configurations of each conversion are built
+    configurations = set()
+    for base, target in conversions:
+        configurations.update(concrete_configurations(base) + concrete_configurations(target))
+    build_library(args.folder, conversion_intrinsics(conversions, intel_vector), args.max_bits, llc=args.llc, configurations=configurations)
+
+    harness = Harness(args.folder)
+    results = verify_conversions(harness, conversions, tests, inputs_fn, batch_size=args.batch_size)
+
+    confirmed = write_results(conversions, results, args.output_folder)
+    print("{} of {} conversions confirmed on {} inputs, using {} configurations".format(
+              len(confirmed), len(conversions), len(tests), len(harness.manifest)),
+          file=sys.stderr)
+
+    if args.header:
+        write_header(confirmed, args.header, args.format)